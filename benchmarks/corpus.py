@@ -0,0 +1,109 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# synthetic markdown corpora for the benchmarks
+
+import os
+import zlib
+import struct
+
+_words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+        'incididunt ut labore et dolore magna aliqua').split()
+
+# span tags that can be nested in each other, a tag can't be nested in itself
+_nestable = (
+        ('<b>', '</b>'),
+        ('<i>', '</i>'),
+        ('<u>', '</u>'),
+        ('<strike>', '</strike>'),
+        ('<font color=red>', '</font>'),
+        ('<strong>', '</strong>'),
+        ('<emphasis>', '</emphasis>'),
+        )
+
+max_nesting = len(_nestable)
+
+def _text(n, seed):
+    return ' '.join(_words[(seed + i * 7) % len(_words)] for i in range(n))
+
+def png_bytes(width, height, rgb):
+    '''
+    a solid color png, written without any imaging library
+    '''
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+    row = b'\x00' + bytes(rgb) * width
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(row * height)) +
+            chunk(b'IEND', b''))
+
+def nested(depth, text):
+    if depth > max_nesting:
+        raise ValueError(f'nesting is at most {max_nesting}')
+    opens = ''.join(o for o, _ in _nestable[:depth])
+    closes = ''.join(c for _, c in reversed(_nestable[:depth]))
+    return f'{opens}{text}{closes}'
+
+def chapter(index, paragraphs, table_rows, table_cols, images, nesting, lists=0):
+    '''
+    markdown of one synthetic input: a heading, paragraphs with tags nested nesting deep,
+    a table_rows x table_cols table, images (img0.png, img1.png ...) and short numbered lists
+    '''
+    lines = [f'# Chapter {index}', '']
+    for p in range(paragraphs):
+        if p % 10 == 0:
+            lines += [f'## Section {index}.{p // 10}', '']
+        tagged = nested(nesting, _text(6, p)) if nesting > 0 else _text(6, p)
+        lines += [f'{_text(12, p)} {tagged} {_text(8, p + 3)}', '']
+
+    if table_rows > 0 and table_cols > 0:
+        lines.append("<table style='Table Grid' caption='synthetic table'>")
+        lines.append('')
+        lines.append('| ' + ' | '.join(f'col {c}' for c in range(table_cols)) + ' |')
+        lines.append('|' + ' --- |' * table_cols)
+        for r in range(table_rows):
+            lines.append('| ' + ' | '.join(
+                f'<b>r{r}</b>' if c == 0 else _text(2, r + c) for c in range(table_cols)) + ' |')
+        lines += ['</table>', '']
+
+    for i in range(images):
+        lines += [f'![](img{i}.png "figure {i}")', '']
+
+    for i in range(lists):
+        # each list restarts its numbering, the second level too
+        lines += [f'steps {i}:', '', f'1. {_text(4, i)}', f'2. {_text(4, i + 1)}', f'   1. {_text(3, i)}', '']
+
+    return '\n'.join(lines) + '\n'
+
+def write_corpus(out_dir, files=1, paragraphs=100, table_rows=20, table_cols=4, images=2, nesting=3, lists=0):
+    '''
+    writes files synthetic inputs (and the images they use) to out_dir, returns their paths
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    for i in range(images):
+        with open(os.path.join(out_dir, f'img{i}.png'), 'wb') as f:
+            f.write(png_bytes(64, 48, ((i * 40) % 256, (i * 90) % 256, 200)))
+
+    paths = []
+    for n in range(files):
+        path = os.path.join(out_dir, f'chapter{n:04d}.md')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(chapter(n, paragraphs, table_rows, table_cols, images, nesting, lists))
+        paths.append(path)
+    return paths
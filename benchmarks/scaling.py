@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# times each pipeline stage on synthetic corpora of growing size and reports how it scales
+#
+#   benchmarks/scaling.py --axis table_rows --sizes 250,500,1000,2000
+#   benchmarks/scaling.py --axis files --sizes 2,4,8,16 --json files.json --check
+#
+# the exponent of a stage is the slope of log(time) over log(size) at the larger sizes,
+# ~1 is linear, ~2 is quadratic. stages above --max_exponent are flagged (and fail with --check)
+
+import io
+import os
+import sys
+import math
+import json
+import time
+import argparse
+import tempfile
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mistletoe import block_token
+from docxcompose.composer import Composer
+
+from text_office import md
+from text_office.md import format_tag
+from text_office.md.session import RenderSession
+from text_office.utils.docx_helper import concat_docx
+
+import corpus
+
+axes = ('paragraphs', 'table_rows', 'table_cols', 'images', 'nesting', 'lists', 'files')
+stages = ('tags', 'tokenize', 'render', 'compose', 'save', 'docx_generate', 'concat_docx')
+
+# stages faster than this at the largest size are too noisy to flag
+_min_flag_time = 0.05
+
+def _span_tags(cls=format_tag.SpanTag):
+    for sub in cls.__subclasses__():
+        if sub.__dict__.get('tag') is not None:
+            yield sub
+        yield from _span_tags(sub)
+
+def _timed(fn, *args):
+    t = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - t, result
+
+def _scan_tags(texts, span_tags):
+    # the tag lexers alone: block tag recognition per line, span tag search per paragraph
+    for text in texts:
+        for line in text.splitlines(keepends=True):
+            format_tag._recognize_block_tag(line)
+        for cls in span_tags:
+            cls.find(text)
+
+def run_once(paths, rel_root):
+    '''
+    times every stage on the inputs at paths, returns {stage: seconds}
+    '''
+    texts = []
+    for p in paths:
+        with open(p, encoding='utf-8') as f:
+            texts.append(f.read())
+
+    result = {}
+    with RenderSession(rel_root=rel_root) as session:
+        session._ensure_tokens()
+        result['tags'], _ = _timed(_scan_tags, texts, list(_span_tags()))
+
+        tokenized = []
+        t = time.perf_counter()
+        for text in texts:
+            tokenized.append(block_token.Document(text.splitlines(keepends=True)))
+        result['tokenize'] = time.perf_counter() - t
+
+        docs = []
+        t = time.perf_counter()
+        for token in tokenized:
+            docs.append(session.renderer.render(token))
+        result['render'] = time.perf_counter() - t
+
+    def compose():
+        comp = Composer(docs[0])
+        for d in docs[1:]:
+            comp.append(d)
+        return comp.doc
+    result['compose'], composed = _timed(compose)
+    result['save'], _ = _timed(composed.save, io.BytesIO())
+
+    result['docx_generate'], _ = _timed(partial(md.docx_generate, list(paths), rel_root=rel_root))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chapters = []
+        with RenderSession(rel_root=rel_root) as session:
+            for i, p in enumerate(paths):
+                out = os.path.join(tmp, f'{i}.docx')
+                session.render_path(p).save(out)
+                chapters.append(out)
+        result['concat_docx'], _ = _timed(concat_docx, chapters)
+
+    return result
+
+def exponent(sizes, times):
+    '''
+    least squares slope of log(time) over log(size) for the larger half of the sizes,
+    fixed costs (template loading, imports) flatten the curve at the small end
+    '''
+    half = len(sizes) // 2 if len(sizes) > 3 else 0
+    pts = [(math.log(s), math.log(t)) for s, t in zip(sizes[half:], times[half:]) if s > 0 and t > 0]
+    if len(pts) < 2:
+        return None
+    mx = sum(x for x, _ in pts) / len(pts)
+    my = sum(y for _, y in pts) / len(pts)
+    var = sum((x - mx) ** 2 for x, _ in pts)
+    if var == 0:
+        return None
+    return sum((x - mx) * (y - my) for x, y in pts) / var
+
+def main():
+    parser = argparse.ArgumentParser(description='per-stage scaling benchmark on synthetic corpora')
+    parser.add_argument('--axis', help='corpus parameter to grow', choices=axes, default='paragraphs')
+    parser.add_argument('--sizes', help='comma separated values of the axis', type=str, default='100,200,400,800')
+    parser.add_argument('--files', help='number of input files', type=int, default=2)
+    parser.add_argument('--paragraphs', help='paragraphs per file', type=int, default=100)
+    parser.add_argument('--table_rows', help='rows of the table in each file', type=int, default=20)
+    parser.add_argument('--table_cols', help='columns of the table in each file', type=int, default=4)
+    parser.add_argument('--images', help='images per file', type=int, default=2)
+    parser.add_argument('--nesting', help=f'span tag nesting depth (at most {corpus.max_nesting})', type=int, default=3)
+    parser.add_argument('--lists', help='short numbered lists per file', type=int, default=0)
+    parser.add_argument('--repeat', help='runs per size, the fastest is kept', type=int, default=3)
+    parser.add_argument('--max_exponent', help='flag stages that scale worse than this', type=float, default=1.3)
+    parser.add_argument('--json', help='write the results to this file', type=str)
+    parser.add_argument('--check', help='exit with 1 if a stage is flagged', action='store_true')
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(',')]
+    params = {a: getattr(args, a) for a in axes}
+    timings = {s: [] for s in stages}
+
+    for size in sizes:
+        params[args.axis] = size
+        best = None
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                paths = corpus.write_corpus(tmp, **params)
+                result = run_once(paths, tmp)
+            best = result if best is None else {k: min(best[k], result[k]) for k in best}
+        for s in stages:
+            timings[s].append(best[s])
+        print(f'{args.axis}={size}: ' + ' '.join(f'{s}={best[s]:.3f}s' for s in stages), file=sys.stderr)
+
+    flagged = []
+    print(f'\n{"stage":<14}' + ''.join(f'{s:>10}' for s in sizes) + f'{"exponent":>10}')
+    for s in stages:
+        k = exponent(sizes, timings[s])
+        flag = k is not None and k > args.max_exponent and timings[s][-1] >= _min_flag_time
+        if flag:
+            flagged.append(s)
+        print(f'{s:<14}' + ''.join(f'{t:>10.3f}' for t in timings[s]) +
+                (f'{k:>10.2f}' if k is not None else f'{"-":>10}') + ('  <- superlinear' if flag else ''))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'axis': args.axis, 'sizes': sizes, 'params': params, 'timings': timings,
+                'exponents': {s: exponent(sizes, timings[s]) for s in stages},
+                'flagged': flagged}, f, indent=2)
+
+    if args.check and flagged:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# times cold starts of text-office.py and lists the heavy modules each command imports
+#
+#   benchmarks/startup.py --repeat 20
+#   benchmarks/startup.py --check
+#
+# commands that render nothing (--version, listonly, tmerge) should not import any of the heavy
+# modules, --check exits with 1 if one does. a render is timed too, for reference
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = os.path.join(root, 'text-office.py')
+samples = os.path.join(root, 'samples')
+
+heavy = ('docx', 'docxcompose', 'lxml', 'mistletoe', 'webcolors', 'cvss', 'PIL')
+
+def commands(tmp):
+    # name: (args, renders something)
+    return {
+            'python': (['-c', 'pass'], False),
+            '--version': ([script, '--version'], False),
+            'listonly': ([script, '-op', 'listonly', samples], False),
+            'tmerge': ([script, '-op', 'tmerge', samples, '-o', os.path.join(tmp, 'merged.md')], False),
+            'render': ([script, os.path.join(samples, 'lists.md'), '-o', os.path.join(tmp, 'lists.docx')], True),
+            }
+
+def imported(args):
+    '''
+    top level packages imported by a run of args, from -X importtime
+    '''
+    out = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=root,
+            capture_output=True, text=True, check=True)
+    names = set()
+    for line in out.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            names.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return names
+
+def timed(args, repeat):
+    # one run first to check the command works and to warm the file cache
+    out = subprocess.run([sys.executable] + args, cwd=root, capture_output=True)
+    if out.returncode != 0:
+        raise RuntimeError(f'{" ".join(args)} failed: {out.stderr.decode()[-500:]}')
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=root, capture_output=True)
+        times.append((time.perf_counter() - t) * 1000)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description='cold start times of text-office.py')
+    parser.add_argument('--repeat', help='runs per command, the median is reported', type=int, default=10)
+    parser.add_argument('--json', help='write the results to this file', type=str)
+    parser.add_argument('--check', help='exit with 1 if a command that renders nothing imports a heavy module', action='store_true')
+    args = parser.parse_args()
+
+    results = {}
+    failed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f'{"command":<12}{"median ms":>10}{"min ms":>10}  heavy modules imported')
+        for name, (cmd, renders) in commands(tmp).items():
+            times = timed(cmd, args.repeat)
+            loaded = sorted(imported(cmd) & set(heavy))
+            results[name] = {'median_ms': statistics.median(times), 'min_ms': min(times), 'heavy': loaded}
+            if loaded and not renders:
+                failed.append(name)
+            print(f'{name:<12}{statistics.median(times):>10.1f}{min(times):>10.1f}  ' + (', '.join(loaded) or '-') +
+                    ('  <- renders nothing' if loaded and not renders else ''))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.check and failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@ printf 'are you sure you want to regenerate the testrefs? yes/(no):'
 read yesno
 if [ "${yesno}" = "yes" ]
 then
-    arr=(dual toc headfoot figures lists tables sections)
+    arr=(dual toc headfoot figures lists tables sections datatable)
 
     for s in ${arr[@]}; do
         python ./text-office.py samples/$s.md -o testrefs/$s.docx
@@ -2,7 +2,7 @@
 
 . bin/activate
 
-arr=(dual toc headfoot figures lists tables sections)
+arr=(dual toc headfoot figures lists tables sections datatable)
 
 mkdir -p testout
 
@@ -16,6 +16,16 @@ for s in ${arr[@]}; do
     diff -qr testout/$s-ref testout/$s
 done;
 
+# the stream backend writes the same documents
+for s in ${arr[@]}; do
+    GEN="python ./text-office.py samples/$s.md --backend stream -o testout/$s-stream.docx"
+    echo $GEN
+    eval $GEN
+    [ ! -f "testout/$s-stream.docx" ] && { echo "error streaming file from samples/$s.md"; continue; }
+    unzip -qq testout/$s-stream.docx -d testout/$s-stream
+    diff -qr testout/$s-ref testout/$s-stream
+done;
+
 # special cases with dxopt
 s='auto_indent'
 GEN="python ./text-office.py samples/$s.md -o testout/$s.docx -dxopt auto_left_indent=0.4in"
@@ -29,4 +39,10 @@ echo $GEN
 eval $GEN
 if [ -f "testout/$s.docx" ]; then unzip -qq testrefs/$s.docx -d testout/$s-ref; unzip -qq testout/$s.docx -d testout/$s; diff -qr testout/$s-ref testout/$s; else echo "error creating file from samples/$s.md"; fi;
 
+# an error in a worker process is reported against the input it came from
+s='errortest'
+GEN="python ./text-office.py samples/lists.md samples/$s.md -j 2 -o testout/$s.docx"
+echo $GEN
+eval $GEN 2>&1 | grep -q "error on input \"samples/$s.md\" - InvalidAttr" || echo "error from samples/$s.md not reported with -j"
+
 rm -rf testout
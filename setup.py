@@ -27,6 +27,9 @@ setup(
         'six==1.16.0',
         'webcolors==1.11.1',
     ],
+    extras_require={
+        'images': ['Pillow'],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Programming Language :: Python :: 3",
@@ -17,13 +17,13 @@ Copyright (C) 2023 ToraNova
 '''
 
 import io
+import sys
 import argparse
 import datetime
 from os import listdir
-from natsort import natsorted
-from os.path import isfile, isdir, join
-from docx import Document
-from docx.document import Document as _DOCX
+from os.path import isfile, isdir, join, getsize
+# python-docx and the renderer are imported by the operations that need them,
+# so that --version, listonly and tmerge start quickly
 from text_office import (
         version,
         md,
@@ -35,112 +35,86 @@ LIST_OP = ['listonly', 'nogen']
 LSTY_OP = ['show_default_styles']
 MKTP_OP = ['mktpl']
 MERG_OP = ['tmerge']
+WATC_OP = ['watch']
+SERV_OP = ['serve']
+BTCH_OP = ['batch']
 
 parser = argparse.ArgumentParser()
 # single
-parser.add_argument('inputs', help='input files', type=str, nargs='*')
+parser.add_argument('inputs', help='input files (- for stdin)', type=str, nargs='*')
 parser.add_argument('-f', '--manifest', help='processing manifest', type=str)
 parser.add_argument('--ascending', help='sort in ascending order (if sorting)', action='store_true')
 parser.add_argument('--nosort', help='do not sort input naturally', action='store_true')
-parser.add_argument('-op', '--operation', help=f'type of operation to do: ({md.OPNAME}), {JOIN_OP}, {LIST_OP}, {MKTP_OP}, {LSTY_OP}, {MERG_OP}', type=str, default='generate')
-parser.add_argument('-o', '--output', help='output docx path', type=str, default='output.docx')
+parser.add_argument('-op', '--operation', help=f'type of operation to do: ({md.OPNAME}), {JOIN_OP}, {LIST_OP}, {MKTP_OP}, {LSTY_OP}, {MERG_OP}, {WATC_OP}, {SERV_OP}, {BTCH_OP}', type=str, default='generate')
+parser.add_argument('-o', '--output', help='output docx path (- for stdout)', type=str, default='output.docx')
 parser.add_argument('-t', '--template', help='template docx path', type=str)
 parser.add_argument('-dxopt', '--docx_opts', action='append', help='key-value pair of docx options (e.g., caption_prefix_heading=1, prompt_updatefield=no)')
 parser.add_argument('--rel_root', help='relative root (for images, attachments)', type=str)
+parser.add_argument('-j', '--jobs', help='number of worker processes to render inputs with (0 for all cores)', type=int, default=1)
+parser.add_argument('--cache_dir', help='directory to cache rendered inputs in, unchanged inputs are not rendered again', type=str)
+parser.add_argument('--cache_size', help='maximum size of the cache in MB', type=int, default=1024)
+parser.add_argument('--nocompose', help='render all inputs into a single document instead of composing them (inputs must share the template)', action='store_true')
+parser.add_argument('--backend', help='docx writer, stream writes the output as it renders and does not compose inputs', choices=['docx', 'stream'], default='docx')
+parser.add_argument('--host', help='address to serve on (serve)', type=str, default='127.0.0.1')
+parser.add_argument('--port', help='port to serve on (serve)', type=int, default=8080)
+parser.add_argument('--queue_size', help='jobs that can wait for a worker before new ones are rejected (serve)', type=int, default=16)
+parser.add_argument('--job_timeout', help='seconds a job may take before it is answered with a timeout (serve)', type=float, default=60)
+parser.add_argument('--resume', help='skip jobs already built by a previous run of the same job file (batch)', action='store_true')
+parser.add_argument('--trace', help='write a timeline of the build stages to this file (chrome trace format, open with ui.perfetto.dev)', type=str)
 parser.add_argument('--version', help='show version number', action='store_true')
-args = parser.parse_args()
 
-if args.version:
-    # show version then exit
-    print('text-office', version)
-    exit(0)
+def collect_inputs(args, _module):
+    '''
+    list the input files from the manifest or the input args, sorted unless told otherwise
+    '''
+    inlist = []
 
-docx = None
+    if args.manifest is not None:
+        # using a manifest file
+        with open(args.manifest, 'r') as mfile:
+            for line in mfile:
+                line = line.strip()
+                if line.startswith('#'):
+                    # ignore comments
+                    continue
 
-# TODO: allow diff modules (e.g., substitute)
-_module = md
+                if line.isspace() or len(line) < 1:
+                    # ignore whitelines
+                    continue
 
-inlist = []
+                if not isfile(line):
+                    # raise error
+                    utils.log.error(f'cannot open specified file in manifest "{args.manifest}" for processing: {line}')
+                    continue
 
-if args.manifest is not None:
-    # using a manifest file
-    if not isfile(args.manifest):
-        utils.log.critical('cannot open manifest for processing')
-        exit(1)
-
-    with open(args.manifest, 'r') as mfile:
-        for line in mfile:
-            line = line.strip()
-            if line.startswith('#'):
-                # ignore comments
-                continue
-
-            if line.isspace() or len(line) < 1:
-                # ignore whitelines
-                continue
-
-            if not isfile(line):
-                # raise error
-                utils.log.error(f'cannot open specified file in manifest "{args.manifest}" for processing: {line}')
-                continue
-
-            if _module.can_process(line):
-                inlist.append(line)
-else:
-    # specifying directly from args
-    for inp in args.inputs:
-        if isfile(inp):
-            # is a file
-            inlist.append(inp)
-        else:
-            for _file in listdir(inp):
-                _filepath = join(inp, _file)
-                if isfile(_filepath) and _module.can_process(_filepath):
-                    inlist.append(_filepath)
-
-if args.nosort or args.operation in MERG_OP:
-    # don't sort
-    pass
-else:
-    # sort
-    inlist = natsorted(inlist, reverse=not args.ascending)
-
-
-if args.operation in LIST_OP:
-    # list target files to process without processing
-    utils.log.info("the following markdown will be processed in order:")
-    for i in inlist:
-        utils.log.info(i)
-
-elif args.operation in JOIN_OP:
-    # concatenate docx
-    docx = utils.docx_helper.concat_docx(inlist)
-
-elif args.operation in MKTP_OP:
-    # create template docx
-    docx = Document()
-
-elif args.operation in LSTY_OP:
-
-    _docx = Document()
-    for s in _docx.styles:
-        print(s)
-    docx = None
-
-elif args.operation in MERG_OP:
-    if args.output.endswith('.docx'):
-        args.output = args.output[:-5] + '.md'
+                if _module.can_process(line):
+                    inlist.append(line)
+    else:
+        # specifying directly from args
+        for inp in args.inputs:
+            if inp == '-' or isfile(inp):
+                # is a file
+                inlist.append(inp)
+            else:
+                for _file in listdir(inp):
+                    _filepath = join(inp, _file)
+                    if isfile(_filepath) and _module.can_process(_filepath):
+                        inlist.append(_filepath)
 
-    with open(args.output, 'w', encoding=utils.default_encoding) as outfile:
-        for md in inlist:
-            with open(md, 'r', encoding=utils.default_encoding) as infile:
-                outfile.write(infile.read())
+    if args.nosort or args.operation in MERG_OP:
+        # don't sort
+        pass
+    else:
+        # sort
+        from natsort import natsorted
+        inlist = natsorted(inlist, reverse=not args.ascending)
 
-else:
-    if len(inlist) < 1:
-        utils.log.critical('no inputs')
-        exit(1)
+    return inlist
 
+def parse_docx_opts(args, raw=False):
+    '''
+    the -dxopt options compiled, or checked and returned as a dict of strings if raw is set
+    '''
     docx_opts = {}
     if args.docx_opts:
         for opt in args.docx_opts:
@@ -148,14 +122,202 @@ else:
             utils.log.debug('dxopt: %s = %s' % (k, v))
             docx_opts[k] = v
 
-    # generate
-    docx = _module.docx_generate(
-            inlist,
-            docx_template=args.template,
-            rel_root=args.rel_root,
-            docx_opts=docx_opts,
-            )
-
-if isinstance(docx, _DOCX):
-    utils.log.info(f'docx generated at {args.output}')
-    docx.save(args.output)
+    try:
+        compiled = utils.DocxOptions.compile(docx_opts)
+        return docx_opts if raw else compiled
+    except (KeyError, ValueError) as e:
+        # bad options would otherwise only fail once rendering reaches them
+        utils.log.critical(f'invalid docx_opts: {e}')
+        exit(1)
+
+def run(args):
+    if args.version:
+        # show version then exit
+        print('text-office', version)
+        exit(0)
+
+    docx = None
+    outname = 'stdout' if args.output == '-' else args.output
+
+    # TODO: allow diff modules (e.g., substitute)
+    _module = md
+
+    if args.manifest is not None and not isfile(args.manifest):
+        utils.log.critical('cannot open manifest for processing')
+        exit(1)
+
+    inlist = collect_inputs(args, _module)
+
+    if args.operation in LIST_OP:
+        # list target files to process without processing
+        utils.log.info("the following markdown will be processed in order:")
+        for i in inlist:
+            utils.log.info(i)
+
+    elif args.operation in JOIN_OP:
+        # concatenate docx
+        docx = utils.docx_helper.concat_docx(inlist)
+
+    elif args.operation in MKTP_OP:
+        # create template docx
+        from docx import Document
+        docx = Document()
+
+    elif args.operation in LSTY_OP:
+        from docx import Document
+
+        _docx = Document()
+        for s in _docx.styles:
+            print(s)
+        docx = None
+
+    elif args.operation in MERG_OP:
+        if args.output.endswith('.docx'):
+            args.output = args.output[:-5] + '.md'
+
+        with open(args.output, 'w', encoding=utils.default_encoding) as outfile:
+            for mdf in inlist:
+                with open(mdf, 'r', encoding=utils.default_encoding) as infile:
+                    outfile.write(infile.read())
+
+    elif args.operation in WATC_OP:
+        from text_office.md.watch import Watcher
+
+        ignored = [o for o, used in (('-j', args.jobs != 1), ('--cache_dir', args.cache_dir),
+                ('--nocompose', args.nocompose), ('--backend', args.backend != 'docx')) if used]
+        if ignored:
+            # watch keeps the rendered inputs in memory and composes them itself
+            utils.log.warning(f'{", ".join(ignored)} not used with -op watch')
+
+        watched = [i for i in args.inputs if isdir(i)]
+        if args.manifest is not None:
+            watched.append(args.manifest)
+
+        Watcher(lambda: collect_inputs(args, _module), args.output,
+                watched=watched,
+                docx_template=args.template,
+                rel_root=args.rel_root,
+                docx_opts=parse_docx_opts(args),
+                ).run()
+
+    elif args.operation in BTCH_OP:
+        from text_office.md.batch import Batch
+
+        if len(args.inputs) != 1 or not isfile(args.inputs[0]):
+            utils.log.critical('batch takes one job file')
+            exit(1)
+
+        try:
+            batch = Batch(args.inputs[0],
+                    jobs=args.jobs,
+                    resume=args.resume,
+                    template=args.template,
+                    rel_root=args.rel_root,
+                    docx_opts=parse_docx_opts(args, raw=True),
+                    )
+        except (OSError, KeyError, ValueError) as e:
+            utils.log.critical(f'invalid job file {args.inputs[0]}: {e}')
+            exit(1)
+        if batch.run() > 0:
+            exit(1)
+
+    elif args.operation in SERV_OP:
+        from text_office.md.serve import RenderServer
+
+        RenderServer(args.host, args.port,
+                jobs=args.jobs,
+                queue_size=args.queue_size,
+                timeout=args.job_timeout,
+                docx_template=args.template,
+                rel_root=args.rel_root,
+                docx_opts=parse_docx_opts(args, raw=True),
+                ).run()
+
+    else:
+        if len(inlist) < 1:
+            utils.log.critical('no inputs')
+            exit(1)
+
+        docx_opts = parse_docx_opts(args)
+
+        cache = None
+        if args.cache_dir:
+            cache = utils.FragmentCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+        output = sys.stdout.buffer if args.output == '-' else args.output
+
+        if '-' in inlist:
+            # markdown from stdin (along with any files given), rendered in memory
+            if args.jobs != 1 or cache is not None:
+                utils.log.warning('jobs and cache are not used when reading from stdin')
+            sources = []
+            for i in inlist:
+                if i == '-':
+                    sources.append(sys.stdin.buffer.read())
+                else:
+                    with open(i, 'rb') as infile:
+                        sources.append(infile.read())
+            _module.render_docx(
+                    sources,
+                    output,
+                    docx_template=args.template,
+                    rel_root=args.rel_root,
+                    docx_opts=docx_opts,
+                    compose=not args.nocompose,
+                    backend=args.backend,
+                    )
+            utils.log.info(f'docx generated at {outname}')
+            return
+
+        if args.backend == 'stream':
+            _module.stream_generate(
+                    inlist,
+                    output,
+                    docx_template=args.template,
+                    rel_root=args.rel_root,
+                    docx_opts=docx_opts,
+                    jobs=args.jobs,
+                    cache=cache,
+                    )
+            utils.log.info(f'docx generated at {outname}')
+            return
+
+        # generate
+        docx = _module.docx_generate(
+                inlist,
+                docx_template=args.template,
+                rel_root=args.rel_root,
+                docx_opts=docx_opts,
+                jobs=args.jobs,
+                cache=cache,
+                compose=not args.nocompose,
+                )
+
+    if docx is not None:
+        utils.log.info(f'docx generated at {outname}')
+        with utils.trace.span('save', path=args.output) as span_args:
+            if args.output == '-':
+                docx.save(sys.stdout.buffer)
+            else:
+                docx.save(args.output)
+                span_args['bytes'] = getsize(args.output)
+
+def main():
+    args = parser.parse_args()
+
+    if args.output == '-':
+        # stdout carries the docx
+        utils.log_helper.log_handler.setStream(sys.stderr)
+
+    if args.trace:
+        utils.trace.start()
+    try:
+        with utils.trace.span('text-office', operation=args.operation):
+            run(args)
+    finally:
+        if args.trace:
+            utils.trace.save(args.trace)
+            utils.log.info(f'trace written to {args.trace}')
+
+if __name__ == '__main__':
+    main()
@@ -15,58 +15,26 @@ Copyright (C) 2023 ToraNova
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-import traceback
-import io
-from mistletoe import block_token
-
-from .. import utils
-from .documentx import Renderer as DocxRenderer
-from docxcompose.composer import Composer
+# markdown to docx
+# the pipeline (md.generate) is imported on first use of one of its functions (PEP 562),
+# commands that only list or merge inputs don't load python-docx, lxml and mistletoe
 
 OPNAME = [
         'mdgen',
         'markdown',
         ]
 
+_generate_names = ('render_file', 'render_path', 'render_docx', 'docx_generate', 'stream_generate',
+        'render_fragment', 'save_fragment', 'load_fragment', 'optimize_images',
+        'precompute_fields')
+
 def can_process(fn):
     return fn.endswith('.md')
 
-def render_file(infile, **kwargs):
-    """
-    Converts markdown input to the output supported by the given renderer.
-    If no renderer is supplied, ``HTMLRenderer`` is used.
-    Note that extra token types supported by the given renderer
-    are automatically (and temporarily) added to the parsing process.
-    """
-    with DocxRenderer(**kwargs) as rdr:
-        outfile = rdr.render(block_token.Document(infile))
-        return outfile
-
-def docx_generate(mdarg, encoding=utils.default_encoding, **kwargs):
-    outf = None
-
-    if isinstance(mdarg, list) and len(mdarg) > 0:
-        try:
-            md = mdarg[0]
-            with open(md, 'r', encoding=encoding) as infile:
-                main_doc = render_file(infile, **kwargs)
-                main_comp = Composer(main_doc)
-
-            for md in mdarg[1:]:
-                with open(md, 'r', encoding=encoding) as infile:
-                    app_doc = render_file(infile, **kwargs)
-                    main_comp.append(app_doc)
-
-            outf = main_comp.doc
-        except Exception as e:
-            # if something messes up here, we must raise
-            # this is a fatal error
-            #utils.log.error(f'error on input "{md}" - {e}')
-            utils.log.exception(f'error on input "{md}" - {e}')
-
-    else:
-        with open(mdarg, 'r', encoding=encoding) as infile:
-            outf = render_file(infile, **kwargs)
-
-    #utils.docx_helper.set_updatefields(outf, 'true')
-    return outf
+def __getattr__(name):
+    if name not in _generate_names:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    from . import generate
+    value = getattr(generate, name)
+    globals()[name] = value
+    return value
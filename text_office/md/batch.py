@@ -0,0 +1,282 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# batch mode, builds the documents listed in a job file in one run
+#
+#   {"defaults": {"template": "tpl.docx", "docx_opts": {"caption_prefix_heading": "1"}},
+#    "jobs": [
+#       {"inputs": ["acme/"], "output": "out/acme.docx"},
+#       {"manifest": "globex/manifest.txt", "output": "out/globex.docx", "rel_root": "globex"}
+#    ]}
+#
+# (a plain list of jobs works too). relative paths are relative to the job file, and so is rel_root
+# by default. directories given as inputs are listed in natural order, listed files and manifests
+# keep their order. a job failing does not stop the others, outputs are written to a temporary
+# file first so a failed job never leaves a broken output behind
+#
+# the outputs built are recorded in <job file>.state, with resume a job is skipped when its output
+# exists and its spec, inputs and template are unchanged since it was built
+
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from natsort import natsorted
+
+from .. import utils, version
+from ..utils.cache_helper import make_key
+from ..utils.docx_helper import DocxPrototype
+from . import can_process
+from .generate import render_docx
+from .session import RenderSession
+
+_job_keys = ('inputs', 'manifest', 'output', 'template', 'rel_root', 'docx_opts', 'compose', 'backend')
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+        return f'{st.st_mtime_ns}:{st.st_size}'
+    except OSError:
+        return ''
+
+# worker process state: parsed templates keyed by path, shared by the sessions of every rel_root
+# and docx_opts they are used with
+_prototypes = {}
+_sessions = {}
+
+def _session(template, rel_root, docx_opts):
+    stamp = None if template is None else _stamp(template)
+    cached = _prototypes.get(template)
+    if cached is None or cached[0] != stamp:
+        _prototypes[template] = (stamp, DocxPrototype(template))
+        for key in [k for k in _sessions if k[0] == template]:
+            _sessions.pop(key).close()
+    key = (template, rel_root, docx_opts)
+    if key not in _sessions:
+        _sessions[key] = RenderSession(template, rel_root, docx_opts, prototype=_prototypes[template][1])
+    return _sessions[key]
+
+def run_job(job):
+    '''
+    builds one (normalized) job, returns (seconds, error message or None)
+    '''
+    t = time.perf_counter()
+    output = job['output']
+    part = output + '.part'
+    try:
+        docx_opts = utils.DocxOptions.compile(job['docx_opts'])
+        session = _session(job['template'], job['rel_root'], docx_opts)
+        sources = []
+        for md in job['inputs']:
+            with open(md, 'rb') as infile:
+                sources.append(infile.read())
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        render_docx(sources, part, compose=job['compose'], backend=job['backend'], session=session,
+                docx_template=job['template'], rel_root=job['rel_root'], docx_opts=docx_opts)
+        os.replace(part, output)
+    except Exception as e:
+        if os.path.exists(part):
+            os.remove(part)
+        return time.perf_counter() - t, f'{type(e).__name__}: {e}'
+    return time.perf_counter() - t, None
+
+def _list_inputs(job, base):
+    if job.get('manifest') is not None:
+        manifest = os.path.join(base, job['manifest'])
+        mbase = os.path.dirname(manifest)
+        inputs = []
+        with open(manifest, 'r') as mfile:
+            for line in mfile:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    inputs.append(os.path.join(mbase, line))
+    else:
+        inputs = []
+        for inp in job.get('inputs', []):
+            inp = os.path.join(base, inp)
+            if os.path.isdir(inp):
+                inputs += natsorted(os.path.join(inp, f) for f in os.listdir(inp)
+                        if can_process(f) and os.path.isfile(os.path.join(inp, f)))
+            else:
+                inputs.append(inp)
+
+    for inp in inputs:
+        if not os.path.isfile(inp):
+            raise FileNotFoundError(f'input \'{inp}\' not found')
+    if not inputs:
+        raise utils.MissingAttr('inputs', _job_keys)
+    return inputs
+
+def load_jobs(path, template=None, rel_root=None, docx_opts=None):
+    '''
+    reads the job file at path and returns its jobs normalized (absolute paths, inputs listed),
+    template, rel_root and docx_opts are the defaults of jobs that (and whose file) don't set them
+    raises on anything invalid, so that a bad job file fails before anything is built
+    '''
+    with open(path, 'r', encoding=utils.default_encoding) as f:
+        spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    base = os.path.dirname(os.path.abspath(path))
+
+    # the defaults given on the command line are relative to the working directory
+    defaults = {'template': template and os.path.abspath(template),
+            'rel_root': rel_root and os.path.abspath(rel_root), 'docx_opts': dict(docx_opts or {}),
+            'compose': True, 'backend': 'docx'}
+    file_defaults = spec.get('defaults', {})
+    for k in file_defaults:
+        if k not in _job_keys:
+            raise utils.InvalidAttr(k, _job_keys)
+    file_opts = file_defaults.get('docx_opts', {})
+    defaults.update(file_defaults)
+    defaults['docx_opts'] = {**dict(docx_opts or {}), **file_opts}
+
+    jobs = []
+    outputs = set()
+    for job in spec.get('jobs', []):
+        for k in job:
+            if k not in _job_keys:
+                raise utils.InvalidAttr(k, _job_keys)
+        if 'output' not in job:
+            raise utils.MissingAttr('output', _job_keys)
+        merged = {**defaults, **job}
+        merged['docx_opts'] = {k: str(v) for k, v in {**defaults['docx_opts'], **job.get('docx_opts', {})}.items()}
+        utils.DocxOptions.compile(merged['docx_opts'])
+        if merged['backend'] not in ('docx', 'stream'):
+            raise utils.InvalidValue('backend', merged['backend'], ['docx', 'stream'])
+
+        output = os.path.normpath(os.path.join(base, merged['output']))
+        if output in outputs:
+            raise utils.InvalidValue('output', merged['output'], 'a path no other job writes to')
+        outputs.add(output)
+        try:
+            inputs, error = _list_inputs(merged, base), None
+        except (OSError, KeyError) as e:
+            # fails this job only
+            inputs, error = [], f'{type(e).__name__}: {e}'
+        jobs.append({
+            'output': output,
+            'inputs': inputs,
+            'error': error,
+            'template': None if merged['template'] is None else os.path.join(base, merged['template']),
+            'rel_root': os.path.join(base, merged['rel_root']) if merged['rel_root'] is not None else base,
+            'docx_opts': merged['docx_opts'],
+            'compose': utils.parse_bool(str(merged['compose'])),
+            'backend': merged['backend'],
+            })
+    return jobs
+
+def fingerprint(job):
+    '''
+    changes whenever the job spec, one of its inputs or its template changes
+    '''
+    stamps = [f'{p}={_stamp(p)}' for p in job['inputs']]
+    if job['template'] is not None:
+        stamps.append(f'{job["template"]}={_stamp(job["template"])}')
+    return make_key(version, json.dumps(job, sort_keys=True), *stamps)
+
+class Batch:
+    '''
+    builds every job of a job file with jobs worker processes (0 for all cores)
+    resume skips jobs already built (see the state file above)
+    '''
+    def __init__(self, path, jobs=1, resume=False, template=None, rel_root=None, docx_opts=None):
+        self.path = path
+        self.state_path = path + '.state'
+        self.jobs = os.cpu_count() if jobs is None or jobs < 1 else jobs
+        self.resume = resume
+        self.todo = load_jobs(path, template, rel_root, docx_opts)
+        self.state = {}
+        self.results = {} # output -> (status, seconds, error)
+
+    def _load_state(self):
+        if not self.resume or not os.path.isfile(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            utils.log.warning(f'{self.state_path} is not readable, building every job')
+            return {}
+
+    def _save_state(self):
+        tmp = self.state_path + '.part'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp, self.state_path)
+
+    def _done(self, job, key, seconds, error):
+        output = job['output']
+        if error is None:
+            self.results[output] = ('ok', seconds, None)
+            self.state[output] = {'fingerprint': key, 'seconds': round(seconds, 3)}
+            utils.log.info(f'{output} built in {seconds:.2f}s')
+        else:
+            self.results[output] = ('failed', seconds, error)
+            self.state.pop(output, None)
+            utils.log.error(f'{output} failed - {error}')
+        self._save_state()
+
+    def run(self):
+        '''
+        builds the jobs, returns the number of jobs that failed
+        '''
+        t = time.perf_counter()
+        self.state = self._load_state()
+        pending = []
+        for job in self.todo:
+            if job['error'] is not None:
+                self._done(job, None, 0, job['error'])
+                continue
+            key = fingerprint(job)
+            done = self.state.get(job['output'])
+            if done is not None and done.get('fingerprint') == key and os.path.isfile(job['output']):
+                self.results[job['output']] = ('skipped', None, None)
+            else:
+                pending.append((job, key))
+        self._save_state()
+
+        if self.jobs > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                futures = {pool.submit(run_job, job): (job, key) for job, key in pending}
+                for fut in as_completed(futures):
+                    job, key = futures[fut]
+                    try:
+                        seconds, error = fut.result()
+                    except Exception as e:
+                        # the worker died, the job did not get to report
+                        seconds, error = 0, f'{type(e).__name__}: {e}'
+                    self._done(job, key, seconds, error)
+        else:
+            for job, key in pending:
+                self._done(job, key, *run_job(job))
+
+        self.summary(time.perf_counter() - t)
+        return sum(1 for status, _, _ in self.results.values() if status == 'failed')
+
+    def summary(self, elapsed):
+        counts = {'ok': 0, 'skipped': 0, 'failed': 0}
+        lines = []
+        for job in self.todo:
+            status, seconds, error = self.results[job['output']]
+            counts[status] += 1
+            took = '' if seconds is None else f'{seconds:.2f}s'
+            lines.append(f'  {status:<8}{took:>9}  {job["output"]}' + (f' - {error}' if error else ''))
+        utils.log.info(f'{len(self.todo)} jobs in {elapsed:.2f}s: {counts["ok"]} built, '
+                f'{counts["skipped"]} skipped, {counts["failed"]} failed')
+        for line in lines:
+            utils.log.info(line)
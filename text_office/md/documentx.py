@@ -22,18 +22,26 @@ import os
 import re
 import webcolors
 
-from io import StringIO
+from io import StringIO, BytesIO
+from copy import deepcopy
+from contextlib import contextmanager
 from itertools import chain
 from mistletoe import block_token, span_token
 from mistletoe.base_renderer import BaseRenderer
 
 from docx import Document
+from docx.oxml.ns import qn
+from docx.table import _Cell
+from docx.text.paragraph import Paragraph
 from .. import utils
 from ..utils.docx_helper import (
         format_paragraph, format_run, format_table, format_tabstops,
         format_figure, format_cell, format_section, insert_pagenum, format_table_border,
-        insert_hyperlink, assign_numbering, insert_section, insert_hrule, merge_table_cells,
+        table_column_widths, add_text_run,
+        insert_hyperlink, RelationshipIndex, character_style_id, NumberingAllocator,
+        add_picture, insert_section, insert_hrule, merge_table_cells,
         make_caption, delete_paragraph, insert_LOF, insert_LOT, insert_TOC, left_indent_from_level,
+        DocxPrototype,
         )
 
 from .format_tag import (
@@ -46,13 +54,30 @@ from .format_tag import (
 from .format_tag import (
         CommentBlockTag, AlignBlockTag, TableBlockTag, ParagraphBlockTag,
         FooterBlockTag, HeaderBlockTag, BorderBlockTag, FontBlockTag,
+        DataTableBlockTag,
         )
 
+# <datatable> options besides those of format_table
+_datatable_opts = ('src', 'format', 'header', 'columns', 'encoding', 'caption', 'caption_align')
+
+def image_sources(images):
+    # image bytes become file objects, add_picture reads each one once per part
+    return {src: BytesIO(img) if isinstance(img, (bytes, bytearray)) else img
+            for src, img in (images or {}).items()}
+
 class Renderer(BaseRenderer):
-    def __init__(self, docx_template=None, rel_root=None, docx_opts=None, *extras):
+    def __init__(self, docx_template=None, rel_root=None, docx_opts=None, *extras, prototype=None, continuous=False,
+            images=None, confined=False):
         '''
-        renders a .docx using docx_template as the template file
+        renders a .docx using docx_template as the template file (a path, the template bytes or a binary file object)
         rel_root determine the path to include relative path resources (e.g., images)
+        prototype is an already parsed DocxPrototype of docx_template to copy documents from
+        continuous renders every document into the same docx, sections, lists and captions carry on
+        from one document to the next
+        images maps image sources, as written in the markdown, to image bytes (or binary file objects)
+        that are used instead of reading the files
+        confined only lets the markdown read files under rel_root (for markdown that is not trusted),
+        absolute paths and paths out of rel_root raise InvalidValue
         '''
         self._suppress_ptag_stack = [False]
         super().__init__(*chain(([
@@ -62,13 +87,19 @@ class Renderer(BaseRenderer):
             FontTag, ImageTag, CellTag, InsertPageNumTag, MergeTag,
             CommentBlockTag, AlignBlockTag, TableBlockTag, ParagraphBlockTag,
             FooterBlockTag, HeaderBlockTag, BorderBlockTag,
-            TOCTag, LOTTag, LOFTag, FontBlockTag,
+            TOCTag, LOTTag, LOFTag, FontBlockTag, DataTableBlockTag,
         ]), extras))
         self.rel_root = os.getcwd() if rel_root is None else rel_root
+        self.confined = confined
         self.docx_template = docx_template
-        self.docx_opts = {}
-        if isinstance(docx_opts, dict):
-            self.docx_opts = docx_opts
+        if prototype is None and docx_template is not None and not isinstance(docx_template, str):
+            # Document() only reads templates from paths and file objects once
+            prototype = DocxPrototype(docx_template)
+        self.prototype = prototype
+        self.images = image_sources(images)
+        self.continuous = continuous
+        self.docx = None
+        self.docx_opts = utils.DocxOptions.compile(docx_opts)
 
     def render_inner(self, token):
         # inner rendering not supported on DocxRenderer
@@ -82,16 +113,6 @@ class Renderer(BaseRenderer):
         level = self.list_level
         self.list_level += 1
 
-        #if 'List Number' in self.docx.styles and 'List Bullet' in self.docx.styles:
-        # old numbering system
-
-        # TODO: fix this abstract_numId map with a more robust implementation
-        anid_map = {
-            0: 7, # numId 5, absnumId 7
-            1: 3, # numId 6, absnumId 3
-            2: 2, # numId 7, absnumId 2
-        }
-
         if ordered:
             stpl = 'List Number '
         else:
@@ -105,16 +126,17 @@ class Renderer(BaseRenderer):
             number = token.start + idx if ordered else None
             # if mistletoe changed the way leader/prepend is computed, this must changed as well
 
-            tos = len(self.paras)
-            for ic in c.children:
-                ic.docx_style = style
-                self.render(ic)
+            with self.collect('para') as added:
+                for ic in c.children:
+                    ic.docx_style = style
+                    self.render(ic)
             #self.populate_and_format_paras(c, style=style)
 
-            added = len(self.paras) - tos
-            #if added > 0 and ordered:
-            if added > 0 and ordered and idx == 0:
-                assign_numbering(self.docx, self.paras[tos], anid_map[level], start=number)
+            #if added and ordered:
+            if added and ordered and idx == 0:
+                if self.numbering is None:
+                    self.numbering = NumberingAllocator(self.docx)
+                self.numbering.restart(added[0], style, start=number)
 
         #elif 'List Paragraph' in self.docx.styles:
 
@@ -148,29 +170,37 @@ class Renderer(BaseRenderer):
             ut = token.target
         else:
             ut = token.title
-        insert_hyperlink(self.paras[-1], ut, token.target)
+        self.insert_link(ut, token.target)
 
     def render_auto_link(self, token):
-        insert_hyperlink(self.paras[-1], token.target, token.target)
+        self.insert_link(token.target, token.target)
+
+    def insert_link(self, txt, url):
+        # links reuse the relationship of a url already linked in the same part (body, header, footer)
+        part = self.para.part
+        rels = self.relationships.get(part)
+        if rels is None:
+            rels = self.relationships[part] = RelationshipIndex(part)
+        if self.link_style is None:
+            self.link_style = character_style_id(self.docx, 'Hyperlink') or ''
+        insert_hyperlink(self.para, txt, url, rels=rels, style_id=self.link_style or None)
 
     def render_image(self, token):
-        if token.src.startswith('/'):
-            img_path = token.src
-        else:
-            img_path = os.path.join(self.rel_root, token.src)
+        img_path = self.images.get(token.src)
+        if img_path is None:
+            img_path = self.resource_path(token.src)
+            if not os.path.isfile(img_path):
+                raise FileNotFoundError(f'image file \'{img_path}\' not found')
+            self.dependencies.append(img_path)
 
-        if not os.path.isfile(img_path):
-            raise FileNotFoundError(f'image file \'{img_path}\' not found')
-
-        self.runs.append(self.paras[-1].add_run())
-        self.inline_shapes.append(self.runs[-1].add_picture(img_path))
+        run = self.add('run', self.para.add_run())
+        self.add('inline_shape', add_picture(run, img_path, self.pictures, self.next_shape_id(run),
+            os.path.basename(token.src)))
 
         # default fig configuration via dxopt
-        _dxopt = utils.parse_default_args(['width', 'border_width', 'border_color'], self.docx_opts, 'default_figure_')
-
-        if _dxopt:
+        if self.docx_opts.default_figure:
             # default format
-            format_figure(self.inline_shapes[-1], **_dxopt)
+            format_figure(self.inline_shape, **dict(self.docx_opts.default_figure))
 
         # skip caption if no caption string
         if len(token.title.strip()) < 1:
@@ -179,8 +209,7 @@ class Renderer(BaseRenderer):
         self.populate_caption('Figure', token.title)
 
     def render_block_code(self, token):
-        _dxopt = utils.parse_bool(self.docx_opts.get('error_on_blockcode', False))
-        if _dxopt:
+        if self.docx_opts.error_on_blockcode:
             raise NotImplementedError('block_codes not supported, use <font name="Lucida Sans Typewriter"></font> instead')
         else:
             par = self.make_paragraph(token)
@@ -188,60 +217,142 @@ class Renderer(BaseRenderer):
             rtobj = token.children[0]
             sio = StringIO(rtobj.content)
             for lines in sio:
-                self.runs.append(self.paras[-1].add_run())
-                self.runs[-1].add_text(lines)
-                self.runs[-1].add_break()
+                run = self.add('run', par.add_run())
+                run.add_text(lines)
+                run.add_break()
 
-    def render_document(self, token):
+    def new_document(self):
         # create document from template
-        if self.docx_template is None:
+        if self.prototype is not None:
+            self.docx = self.prototype.new_document()
+        elif self.docx_template is None:
             self.docx = Document()
         else:
             self.docx = Document(self.docx_template)
+
+        if self.docx_template is not None:
             delete_paragraph(self.docx.paragraphs[-1])
 
-        # paragraph and run stack
         self.list_level = 0 # default root level
         self.heading_level = None # no heading level
-        self.runs = []
-        self.paras = self.docx.paragraphs.copy()
-        self.tables = self.docx.tables.copy()
+
+        # last element of each kind added, tags that change "the last ..." work on these
+        paras = self.docx.paragraphs
+        tables = self.docx.tables
+        self.para = paras[-1] if paras else None
+        self.run = None
+        self.table = tables[-1] if tables else None
+        self.cell = None
+        self.table_row = None # w:tr of the table row being rendered
+        self.inline_shape = None
+        # kind -> lists of elements added in each open collect() scope, innermost last
+        self.collectors = {k: [] for k in ('para', 'run', 'table', 'inline_shape')}
+        # where paragraphs go, header and footer blocks switch it for the paragraphs inside them
+        self.target = self.docx
+
+        self.synthesizer = None
+        if self.docx_opts.synthesize_styles > 0:
+            self.synthesizer = utils.StyleSynthesizer(self.docx, self.docx_opts.synthesize_styles)
+
         self.sections = []
         for s in self.docx.sections:
             self.sections.append(s)
-        self.cells = []
-        self.inline_shapes = []
+        self.pictures = {}
+        self.numbering = None # NumberingAllocator, made for the first ordered list
+        self.relationships = {} # part -> RelationshipIndex, for links
+        self.link_style = None # id of the template's Hyperlink style, '' if it has none
+        self.dependencies = [] # files other than the markdown that were read during render
+        return self.docx
+
+    def resource_path(self, src):
+        '''
+        path of a file the markdown refers to (e.g., an image), relative paths are relative to rel_root
+        '''
+        if not self.confined:
+            return src if os.path.isabs(src) else os.path.join(self.rel_root, src)
+
+        if os.path.isabs(src) or '..' in src.replace('\\', '/').split('/'):
+            raise utils.InvalidValue('src', src, 'a relative path under rel_root')
+        # symbolic links must not lead out of rel_root either
+        root = os.path.realpath(self.rel_root)
+        path = os.path.realpath(os.path.join(root, src))
+        if os.path.commonpath([root, path]) != root:
+            raise utils.InvalidValue('src', src, 'a relative path under rel_root')
+        return path
+
+    def next_shape_id(self, run):
+        # id for the next drawing added to run
+        return run.part.next_id
+
+    def render_document(self, token):
+        if self.docx is None or not self.continuous:
+            self.new_document()
+        body = self.docx.element.body
+        start = len(body) - (1 if len(body) and body[-1].tag == qn('w:sectPr') else 0)
         self.render_inner(token)
 
+        if self.synthesizer is not None:
+            self.synthesizer.process([c for c in body[start:] if c.tag != qn('w:sectPr')])
+
         # save document
         #self.docx.save(self.out_path)
         return self.docx
 
+    def add(self, kind, element):
+        # element becomes the last of its kind, and is collected by the innermost open scope
+        setattr(self, kind, element)
+        collectors = self.collectors.get(kind)
+        if collectors:
+            collectors[-1].append(element)
+        return element
+
+    @contextmanager
+    def collect(self, kind):
+        '''
+        scope that yields the list of elements of kind added while it is open,
+        they are handed on to the enclosing scope when it closes
+        '''
+        added = []
+        collectors = self.collectors[kind]
+        collectors.append(added)
+        try:
+            yield added
+        finally:
+            collectors.pop()
+            if collectors:
+                collectors[-1].extend(added)
+
+    @contextmanager
+    def render_target(self, target):
+        # paragraphs rendered in this scope are added to target
+        parent = self.target
+        self.target = target
+        try:
+            yield target
+        finally:
+            self.target = parent
+
     def populate_and_format_runs(self, token, **kwargs):
         # format_tag allows nested formatting <b><i>test</i></b>, italic and bold
-        tos = len(self.runs) # top of stack
-        self.render_inner(token)
-        added = len(self.runs) - tos # new top of stack
+        with self.collect('run') as added:
+            self.render_inner(token)
         # apply format to all added elements during inner render
-        for i in range(added):
-            format_run(self.runs[-(i+1)], **kwargs)
+        for run in reversed(added):
+            format_run(run, **kwargs)
 
     def populate_and_format_paras(self, token, **kwargs):
-        tos = len(self.paras)
-        self.render_inner(token)
-        added = len(self.paras) - tos
+        with self.collect('para') as added:
+            self.render_inner(token)
         # apply format to all added elements during inner render
-        for i in range(added):
-            tar = self.paras[-(i+1)]
+        for tar in reversed(added):
             format_paragraph(tar, **kwargs)
 
     def populate_and_format_tables(self, token, **kwargs):
-        tos = len(self.tables) # top of stack
-        self.render_inner(token)
-        added = len(self.tables) - tos # new top of stack
+        with self.collect('table') as added:
+            self.render_inner(token)
         # add style to all added table within this block
-        for i in range(added):
-            format_table(self.tables[-(i+1)], **kwargs)
+        for table in reversed(added):
+            format_table(table, **kwargs)
 
     def render_font_tag(self, token):
         self.populate_and_format_runs(token, **token.format)
@@ -276,21 +387,13 @@ class Renderer(BaseRenderer):
     def render_heading(self, token):
         # assume that heading has no additional child
         self.heading_level = token.level
-        tar = self.docx.add_heading(level=token.level).clear()
-        self.paras.append(tar)
+        tar = self.add('para', self.docx.add_heading(level=token.level).clear())
         self.render_inner(token)
         self.auto_left_indent(tar, token.level-1)
 
-    def make_paragraph(self, token):
-        render_ptr = self.docx
-        if hasattr(token, 'render_to') and isinstance(token.render_to, str):
-            if token.render_to == 'header':
-                render_ptr = self.sections[-1].header
-
-            elif token.render_to == 'footer':
-                render_ptr = self.sections[-1].footer
-        else:
-            token.render_to = 'body'
+    def make_paragraph(self, token, render_ptr=None):
+        if render_ptr is None:
+            render_ptr = self.docx
 
         if hasattr(token, 'docx_style') and isinstance(token.docx_style, str):
             par = render_ptr.add_paragraph(style=token.docx_style)
@@ -298,17 +401,16 @@ class Renderer(BaseRenderer):
             par = render_ptr.add_paragraph()
         par.clear()
 
-        self.paras.append(par)
-        return par
+        return self.add('para', par)
 
     def render_paragraph(self, token):
-        # for all span tokens
-        par = self.make_paragraph(token)
+        # for all span tokens, only paragraphs follow the render target into headers/footers
+        par = self.make_paragraph(token, self.target)
         self.render_inner(token)
         self.auto_left_indent(par)
 
     def auto_left_indent(self, obj, lvl = None):
-        _dxopt = utils.parse_docx_sizespec(self.docx_opts.get('auto_left_indent', None))
+        _dxopt = self.docx_opts.auto_left_indent
         if not _dxopt:
             return
         if not isinstance(self.heading_level, int):
@@ -320,51 +422,41 @@ class Renderer(BaseRenderer):
         left_indent_from_level(obj, lvl, _dxopt)
 
     def render_horizontal_rule_tag(self, token):
-        insert_hrule(self.paras[-1], token.format_value)
+        insert_hrule(self.para, token.format_value)
 
     def render_thematic_break(self, token):
-        insert_hrule(self.paras[-1])
+        insert_hrule(self.para)
 
     def render_page_break_tag(self, token):
         self.docx.add_page_break()
 
     def render_toc_tag(self, token):
-        self.runs.append(self.paras[-1].add_run())
-        _dxopt = utils.parse_bool(self.docx_opts.get('prompt_updatefield', True))
-        insert_TOC(self.runs[-1], _dxopt)
+        insert_TOC(self.add('run', self.para.add_run()), self.docx_opts.prompt_updatefield)
 
     def render_lot_tag(self, token):
-        self.runs.append(self.paras[-1].add_run())
-        _dxopt = utils.parse_bool(self.docx_opts.get('prompt_updatefield', True))
-        insert_LOT(self.runs[-1], _dxopt)
+        insert_LOT(self.add('run', self.para.add_run()), self.docx_opts.prompt_updatefield)
 
     def render_lof_tag(self, token):
-        self.runs.append(self.paras[-1].add_run())
-        _dxopt = utils.parse_bool(self.docx_opts.get('prompt_updatefield', True))
-        insert_LOF(self.runs[-1], _dxopt)
+        insert_LOF(self.add('run', self.para.add_run()), self.docx_opts.prompt_updatefield)
 
     def render_raw_text(self, token):
         # add run to last added paragraph
-        self.runs.append(self.paras[-1].add_run())
-        self.runs[-1].add_text(token.content)
+        self.add('run', self.para.add_run()).add_text(token.content)
 
     def render_line_break(self, token):
-        self.runs.append(self.paras[-1].add_run())
-        self.runs[-1].add_break()
+        self.add('run', self.para.add_run()).add_break()
 
     def render_line_break_tag(self, token):
-        self.runs.append(self.paras[-1].add_run())
-        self.runs[-1].add_break()
+        self.add('run', self.para.add_run()).add_break()
 
     def render_insert_tab_tag(self, token):
         # insert a tab character
-        if len(self.runs) < 1:
-            self.runs.append(self.paras[-1].add_run())
-        self.runs[-1].add_tab()
+        if self.run is None:
+            self.add('run', self.para.add_run())
+        self.run.add_tab()
 
     def render_insert_page_num_tag(self, token):
-        self.runs.append(self.paras[-1].add_run())
-        insert_pagenum(self.sections[-1], self.runs[-1], **token.format)
+        insert_pagenum(self.sections[-1], self.add('run', self.para.add_run()), **token.format)
 
     def render_section_break_tag(self, token):
         # insert new section
@@ -385,44 +477,113 @@ class Renderer(BaseRenderer):
         if len(token.children) < 1:
             return
         ncol = len(token.children[0].children)
-        tbltar = self.docx.add_table(0, ncol)
-        self.tables.append(tbltar)
-
-        if hasattr(token, 'header') and token.header is not None:
-            token.header.is_header = True
-            self.render(token.header)
-
-        for row in token.children:
-            row.is_header = False
+        header = getattr(token, 'header', None)
+        rows = ([header] if header is not None else []) + list(token.children)
+
+        # every row is created up front, python-docx builds the whole grid from one template
+        tbltar = self.add('table', self.docx.add_table(len(rows), ncol))
+        for row, tr in zip(rows, tbltar._tbl.tr_lst):
+            row.is_header = row is header
+            self.table_row = tr
             self.render(row)
+        self.table_row = None
 
         if len(tbltar.rows) < 1:
             # table has no rows, warn
             utils.log.warn('table has no rows')
 
         # default table configuration via dxopt
-        _dxopt = utils.parse_default_args(['style', 'align', 'autofit', 'column_widths'], self.docx_opts, 'default_table_')
-
-        if _dxopt:
+        if self.docx_opts.default_table:
             # default format
-            format_table(tbltar, **_dxopt)
+            format_table(tbltar, **dict(self.docx_opts.default_table))
 
         self.auto_left_indent(tbltar)
 
 
     def render_table_row(self, token):
-        row = self.tables[-1].add_row()
+        # cells straight from the row's w:tc elements, row.cells would go over the whole table
+        tcs = self.table_row.tc_lst
         for cidx, col in enumerate(token.children):
-            if cidx >= len(row.cells):
-                utils.log.warn('table has %d columns but a row has %d columns: %s' % (len(row.cells), cidx+1, str([c.content for c in col.children])))
+            if cidx >= len(tcs):
+                utils.log.warn('table has %d columns but a row has %d columns: %s' % (len(tcs), cidx+1, str([c.content for c in col.children])))
                 continue
-            self.cells.append(row.cells[cidx])
+            self.cell = _Cell(tcs[cidx], self.table)
             self.render(col)
 
     def render_table_cell(self, token):
-        self.paras.append(self.cells[-1].paragraphs[0])  # add default para on cell
+        self.add('para', self.cell.paragraphs[0])  # add default para on cell
         self.render_inner(token)
 
+    def render_data_table_block_tag(self, token):
+        opts = dict(token.format)
+        src = opts.pop('src', None)
+        if src is None:
+            raise utils.MissingAttr('src', _datatable_opts)
+        path = self.resource_path(src)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f'data file \'{path}\' not found')
+        self.dependencies.append(path)
+
+        columns = opts.pop('columns', None)
+        rows = utils.iter_data_rows(path, opts.pop('format', None),
+                utils.parse_bool(opts.pop('header', 'yes')),
+                [c.strip() for c in columns.split(',')] if columns else None,
+                opts.pop('encoding', utils.default_encoding))
+
+        caption = opts.pop('caption', None)
+        caption_align = opts.pop('caption_align', None)
+        first = next(rows, None)
+        if first is None:
+            utils.log.warn(f'{src} has no rows')
+            return
+        if caption is not None:
+            self.populate_caption('Table', caption, align=caption_align)
+
+        # rows are copies of an empty row and filled in directly, a proxy is only made for the
+        # cell paragraphs when an enclosing tag collects them
+        ncol = len(first)
+        tbltar = self.add('table', self.docx.add_table(0, ncol))
+        tbl = tbltar._tbl
+        proto = tbltar.add_row()._tr
+        tbl.remove(proto)
+
+        # column widths are given to the row copied instead of every cell afterwards
+        table_opts = [dict(self.docx_opts.default_table), opts]
+        for o in table_opts:
+            if 'column_widths' in o:
+                cwidths = table_column_widths(tbltar, o.pop('column_widths'))
+                for tc, w in zip(proto.tc_lst, cwidths):
+                    tc.width = w
+                tbltar.autofit = False
+
+        collect = bool(self.collectors['para'])
+        last = None
+        for values in chain([first], rows):
+            if len(values) > ncol:
+                utils.log.warn(f'{src} has {ncol} columns but a row has {len(values)}: {values}')
+            tr = deepcopy(proto)
+            for tc, v in zip(tr.tc_lst, values):
+                p = tc.p_lst[0]
+                if v:
+                    add_text_run(p, v)
+                if collect:
+                    self.add('para', Paragraph(p, _Cell(tc, tbltar)))
+                last = tc
+            tbl.append(tr)
+
+        # as after a markdown table, the last cell and its paragraph are the last ones added
+        if last is not None:
+            self.cell = _Cell(last, tbltar)
+            if not collect:
+                self.para = Paragraph(last.p_lst[0], self.cell)
+
+        # default table configuration via dxopt, then the tag's
+        for o in table_opts:
+            if o:
+                format_table(tbltar, **o)
+
+        self.auto_left_indent(tbltar)
+
     def render_table_block_tag(self, token):
         # additional valid opts
         if isinstance(token.format.get('caption'), str):
@@ -434,45 +595,39 @@ class Renderer(BaseRenderer):
         self.populate_and_format_tables(token, **token.format)
 
     def render_cell_tag(self, token):
-        if len(self.cells) < 1:
+        if self.cell is None:
             return
 
         self.render_inner(token)
-        format_cell(self.cells[-1], **token.format)
+        format_cell(self.cell, **token.format)
 
     def render_merge_tag(self, token):
-        if len(self.tables) < 1:
+        if self.table is None:
             return
 
-        merge_table_cells(self.tables[-1], **token.format)
+        merge_table_cells(self.table, **token.format)
 
     def render_border_block_tag(self, token):
-        tos = len(self.tables)
-        self.render_inner(token)
-        added = len(self.tables) - tos
-        for i in range(added):
-            target = self.tables[-(i+1)]
+        with self.collect('table') as added:
+            self.render_inner(token)
+        for target in reversed(added):
             format_table_border(target, **token.format)
 
     def render_align_block_tag(self, token):
         self.populate_and_format_paras(token, align=token.format_value)
 
     def populate_caption(self, caption_type, caption_string, **kwargs):
-        tcpar = self.docx.add_paragraph(style='Caption').clear()
-        self.paras.append(tcpar)
+        tcpar = self.add('para', self.docx.add_paragraph(style='Caption').clear())
         # self.auto_left_indent(tcpar)  # uncomment this to auto-indent captions
         format_paragraph(tcpar, **kwargs)
-        _dxopt = int(self.docx_opts.get('caption_prefix_heading', 0))
-        make_caption(tcpar.add_run(f'{caption_type} '), _dxopt, caption_type)
+        make_caption(tcpar.add_run(f'{caption_type} '), self.docx_opts.caption_prefix_heading, caption_type)
 
         tcrun = tcpar.add_run(f': {caption_string}')
 
     def render_image_tag(self, token):
-        tos = len(self.inline_shapes)
-        self.render_inner(token)
-        added = len(self.inline_shapes) - tos
-        for i in range(added):
-            target = self.inline_shapes[-(i+1)]
+        with self.collect('inline_shape') as added:
+            self.render_inner(token)
+        for target in reversed(added):
             format_figure(target, **token.format)
 
     def render_paragraph_block_tag(self, token):
@@ -480,13 +635,13 @@ class Renderer(BaseRenderer):
 
     def render_header_block_tag(self, token):
         _tsalign = format_tabstops(token.format.get('tabstops'), self.sections[-1])
-        utils.set_attr_recursively(token, block_token.Paragraph, 'render_to', 'header')
-        self.populate_and_format_paras(token, tabstops=_tsalign)
+        with self.render_target(self.sections[-1].header):
+            self.populate_and_format_paras(token, tabstops=_tsalign)
 
     def render_footer_block_tag(self, token):
         _tsalign = format_tabstops(token.format.get('tabstops'), self.sections[-1])
-        utils.set_attr_recursively(token, block_token.Paragraph, 'render_to', 'footer')
-        self.populate_and_format_paras(token, tabstops=_tsalign)
+        with self.render_target(self.sections[-1].footer):
+            self.populate_and_format_paras(token, tabstops=_tsalign)
 
     def render_font_block_tag(self, token):
         self.populate_and_format_runs(token, **token.format)
@@ -20,6 +20,7 @@ Copyright (C) 2023 ToraNova
 # https://github.com/miyuchina/mistletoe/blob/master/mistletoe/html_renderer.py
 
 import re
+from bisect import bisect_left
 from ..utils import parse_kv_pairs
 from mistletoe.span_token import SpanToken, RawText
 from mistletoe.block_token import BlockToken, tokenize
@@ -52,13 +53,93 @@ class KeyValueMixin:
             self.format = parse_kv_pairs(self.format_value_raw, item_sep=' \n\t')
 
 
-class NoAttrFormatTag(SpanToken):
+# positions of '<' in the last string searched, mistletoe asks every span tag class about the
+# same string in turn
+_lt_scanned = [None, None]
+
+def _lt_positions(string):
+    if _lt_scanned[0] is string:
+        return _lt_scanned[1]
+    positions = []
+    i = string.find('<')
+    while i >= 0:
+        positions.append(i)
+        i = string.find('<', i + 1)
+    _lt_scanned[0] = string
+    _lt_scanned[1] = positions
+    return positions
+
+class SpanTag(SpanToken):
+    '''
+    span tag, subclasses set tag and get their pattern from build_pattern
+    matches are only tried where the string has a '<tag', and a tag with a body is only tried
+    when its end tag comes later in the string, so each search is linear in the string
+    '''
+    tag = None
+    has_body = True
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        tag = cls.__dict__.get('tag')
+        if tag is None:
+            return
+        cls.pattern = re.compile(cls.build_pattern(tag), re.DOTALL)
+        cls._opener = '<' + tag
+        cls._opener_re = re.compile(cls.build_opener(tag))
+        cls._closer = f'</{tag}>' if cls.has_body else None
+
+    @classmethod
+    def find(cls, string):
+        # same matches as cls.pattern.finditer(string)
+        positions = _lt_positions(string)
+        if not positions:
+            return ()
+
+        opener = cls._opener
+        closers = None
+        matches = []
+        pos = 0
+        for p in positions:
+            if p < pos or not string.startswith(opener, p):
+                continue
+            if cls._closer is not None:
+                om = cls._opener_re.match(string, p)
+                if om is None:
+                    continue
+                if closers is None:
+                    closers = [c for c in positions if string.startswith(cls._closer, c)]
+                if bisect_left(closers, om.end()) == len(closers):
+                    # not closed, and neither is any tag after it
+                    break
+            m = cls.pattern.match(string, p)
+            if m is not None:
+                matches.append(m)
+                pos = m.end()
+        return matches
+
+class NoAttrFormatTag(SpanTag):
     parse_group = 1
 
+    @staticmethod
+    def build_pattern(tag):
+        return _build_regex_ftag_noattr_pattern(tag)
+
+    @staticmethod
+    def build_opener(tag):
+        return f'<{tag}>'
+
 
-class FormatTag(SpanToken):
+class FormatTag(SpanTag):
     parse_group = 2
 
+    @staticmethod
+    def build_pattern(tag):
+        return _build_regex_ftag_pattern(tag)
+
+    @staticmethod
+    def build_opener(tag):
+        return _build_regex_ftag_uni_pattern(tag)
+
     def __init__(self, match):
         self.format_value = None
         self.format_value_raw = match.group(1)
@@ -71,6 +152,11 @@ class FormatTag(SpanToken):
 class NoBodyFormatTag(FormatTag):
     parse_group = 0
     parse_inner = False
+    has_body = False
+
+    @staticmethod
+    def build_pattern(tag):
+        return _build_regex_ftag_uni_pattern(tag)
 
 
 class KeyValueFormatTag(KeyValueMixin, FormatTag):
@@ -84,64 +170,64 @@ class KeyValueNoBodyFormatTag(KeyValueMixin, NoBodyFormatTag):
         self.parse_format()
 
 class BoldTag(NoAttrFormatTag):
-    pattern = re.compile(_build_regex_ftag_noattr_pattern('b'), re.DOTALL)
+    tag = 'b'
 
 class ItalicTag(NoAttrFormatTag):
-    pattern = re.compile(_build_regex_ftag_noattr_pattern('i'), re.DOTALL)
+    tag = 'i'
 
 class UnderlineTag(NoAttrFormatTag):
-    pattern = re.compile(_build_regex_ftag_noattr_pattern('u'), re.DOTALL)
+    tag = 'u'
 
 class StrongTag(NoAttrFormatTag):
-    pattern = re.compile(_build_regex_ftag_noattr_pattern('strong'), re.DOTALL)
+    tag = 'strong'
 
 class EmphasisTag(NoAttrFormatTag):
-    pattern = re.compile(_build_regex_ftag_noattr_pattern('emphasis'), re.DOTALL)
+    tag = 'emphasis'
 
 class StrikethroughTag(NoAttrFormatTag):
-    pattern = re.compile(_build_regex_ftag_noattr_pattern('strike'), re.DOTALL)
+    tag = 'strike'
 
 class FontTag(KeyValueFormatTag):
-    pattern = re.compile(_build_regex_ftag_pattern('font'), re.DOTALL)
+    tag = 'font'
 
 class ImageTag(KeyValueFormatTag):
-    pattern = re.compile(_build_regex_ftag_pattern('img'), re.DOTALL)
+    tag = 'img'
 
 class CellTag(KeyValueFormatTag):
-    pattern = re.compile(_build_regex_ftag_pattern('cell'), re.DOTALL)
+    tag = 'cell'
 
 class HorizontalRuleTag(NoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('hr'))
+    tag = 'hr'
 
 class LineBreakTag(NoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('br'))
+    tag = 'br'
 
 class SectionBreakTag(NoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('secbr'))
+    tag = 'secbr'
 
 class InsertTabTag(NoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('tab'))
+    tag = 'tab'
 
 class PageBreakTag(NoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('pgbr'))
+    tag = 'pgbr'
 
 class TOCTag(NoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('toc'))
+    tag = 'toc'
 
 class LOTTag(NoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('lot'))
+    tag = 'lot'
 
 class LOFTag(NoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('lof'))
+    tag = 'lof'
 
 class MergeTag(KeyValueNoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('merge'))
+    tag = 'merge'
 
 class InsertPageNumTag(KeyValueNoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('pgnum'))
+    tag = 'pgnum'
 
 class SectionControlTag(KeyValueNoBodyFormatTag):
-    pattern = re.compile(_build_regex_ftag_uni_pattern('section'))
+    tag = 'section'
 
 class NoNewLineException(Exception):
 
@@ -152,35 +238,74 @@ class ParseException(Exception):
     def __init__(self, tagname, start, lines):
         super().__init__(f'failed to parse {tagname} tag: "{start}" with lines {lines}')
 
+# block tags by tag name, filled in as FormatBlockTag subclasses are defined
+_block_tags = {}
+
+# remainder of a block start line after '<tag'
+_block_start_rest = re.compile(f'\\s*{_attr_matcher}?[>\n]')
+
+# last line looked at and the block tag class it starts, mistletoe asks every block tag class
+# about the same line in turn
+_recognized = [None, None]
+
+def _recognize_block_tag(line):
+    '''
+    the FormatBlockTag class that line starts, or None
+    when tag names share a prefix (para, param), the longest one wins
+    '''
+    if _recognized[0] is line:
+        return _recognized[1]
+
+    cls = None
+    stripped = line.lstrip()
+    if stripped[:1] == '<' and len(line) - len(stripped) < 4:
+        for tag in _block_tags_by_length():
+            if stripped.startswith(tag, 1) and _block_start_rest.match(stripped, len(tag) + 1):
+                cls = _block_tags[tag]
+                break
+
+    _recognized[0] = line
+    _recognized[1] = cls
+    return cls
+
+_block_tags_sorted = []
+
+def _block_tags_by_length():
+    if len(_block_tags_sorted) != len(_block_tags):
+        _block_tags_sorted[:] = sorted(_block_tags, key=len, reverse=True)
+    return _block_tags_sorted
+
 class FormatBlockTag(BlockToken):
 
-    _end_cond = None
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        tag = cls.__dict__.get('tag')
+        if tag is None:
+            return
+        cls._start_re = re.compile(_build_regex_ftag_start_pattern(tag), re.DOTALL)
+        cls._end_tag = f'</{tag}>'
+        cls._end_re = re.compile(re.escape(cls._end_tag), re.IGNORECASE)
+        _block_tags[tag] = cls
 
     def __init__(self, lines):
+        start_token = None
         try:
-            start_token = re.search(_build_regex_ftag_start_pattern(self.tag), lines[0], re.DOTALL)
+            start_token = self._start_re.search(lines[0])
             self.format_value_raw = start_token.group(1)
             if self.format_value_raw is not None:
                 self.format_value = self.format_value_raw.casefold()
             lines[0] = lines[0][start_token.span()[1]:]
             if len(lines[-1].strip()) < 1:
                 raise NoNewLineException(self.tag)
-            end_token =re.search(f'</{self.tag}>', lines[-1])
-            lines[-1] = lines[-1][:end_token.span()[0]]
+            lines[-1] = lines[-1][:lines[-1].index(self._end_tag)]
             super().__init__(lines, tokenize)
         except Exception as e:
-            raise ParseException(self.tag, start_token.group(0), ''.join(lines))
+            raise ParseException(self.tag, start_token.group(0) if start_token else None, ''.join(lines))
 
     @classmethod
     def start(cls, line):
-        stripped = line.lstrip()
-        if len(line) - len(stripped) >= 4:
-            return False
-
         # rule 1: <pre>, <script> or <style> tags, allow newlines in block
-        match_obj = re.match(_build_regex_ftag_start_pattern(cls.tag), stripped, re.DOTALL)
-        cls._end_cond = f'</{cls.tag}>'
-        if match_obj is not None:
+        if _recognize_block_tag(line) is cls:
             return 1
         return False
 
@@ -188,13 +313,10 @@ class FormatBlockTag(BlockToken):
     def read(cls, lines):
         # note: stop condition can trigger on the starting line
         line_buffer = []
+        end_re = cls._end_re
         for line in lines:
             line_buffer.append(line)
-            if cls._end_cond is not None:
-                if cls._end_cond in line.casefold():
-                    break
-            elif line.strip() == '':
-                line_buffer.pop()
+            if end_re.search(line):
                 break
         return line_buffer
 
@@ -228,3 +350,18 @@ class FooterBlockTag(FormatKeyValueBlockTag):
 
 class FontBlockTag(FormatKeyValueBlockTag):
     tag = 'param'
+
+# table read from a data file, <datatable src=hosts.csv ...> on a line of its own
+class DataTableBlockTag(FormatKeyValueBlockTag):
+    tag = 'datatable'
+
+    def __init__(self, lines):
+        start_token = self._start_re.search(lines[0])
+        self.format_value_raw = start_token.group(1)
+        self.parse_format()
+        self.children = []
+
+    @classmethod
+    def read(cls, lines):
+        # no body, an optional </datatable> on the same line is ignored
+        return [next(lines)]
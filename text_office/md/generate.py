@@ -0,0 +1,374 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# the markdown to docx pipeline: single, composed, parallel, cached, streamed and in-memory builds
+
+import os
+import traceback
+import io
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from mistletoe import block_token
+
+from .. import utils, version
+from ..utils.cache_helper import make_key
+from .documentx import Renderer as DocxRenderer
+from .streamx import Renderer as StreamRenderer
+from .session import RenderSession
+from ..utils.docx_helper import report_dedupe_images
+from docx import Document
+from docxcompose.composer import Composer
+
+def render_file(infile, **kwargs):
+    """
+    Converts markdown input to the output supported by the given renderer.
+    If no renderer is supplied, ``HTMLRenderer`` is used.
+    Note that extra token types supported by the given renderer
+    are automatically (and temporarily) added to the parsing process.
+    """
+    with DocxRenderer(**kwargs) as rdr:
+        outfile = rdr.render(block_token.Document(infile))
+        return outfile
+
+def render_path(md, encoding=utils.default_encoding, **kwargs):
+    with open(md, 'r', encoding=encoding) as infile:
+        return render_file(infile, **kwargs)
+
+# sessions kept warm in this (worker) process, keyed by their render options
+_sessions = {}
+
+def _session_for(kwargs):
+    key = (kwargs.get('docx_template'), kwargs.get('rel_root'),
+            utils.DocxOptions.compile(kwargs.get('docx_opts')))
+    if key not in _sessions:
+        _sessions[key] = RenderSession(**kwargs)
+    return _sessions[key]
+
+def save_fragment(doc):
+    with utils.trace.span('save fragment') as args:
+        outb = io.BytesIO()
+        doc.save(outb)
+        args['bytes'] = outb.tell()
+    return outb.getvalue()
+
+def load_fragment(fragment):
+    with utils.trace.span('load fragment', bytes=len(fragment)):
+        return Document(io.BytesIO(fragment))
+
+def _chapter_key(session, md, encoding):
+    # everything that goes into a rendered chapter, besides the files it references
+    rdr = session.renderer
+    with open(md, 'rb') as infile:
+        blob = infile.read()
+    return make_key(version, encoding, session.prototype.digest,
+            repr(rdr.docx_opts), os.path.abspath(rdr.rel_root), blob)
+
+def render_fragment(md, encoding=utils.default_encoding, cache=None, **kwargs):
+    '''
+    renders a single markdown file and returns the resulting .docx as bytes,
+    this is what the worker processes hand back to the composer
+    '''
+    with utils.trace.span('chapter', path=md) as args:
+        session = _session_for(kwargs)
+        if cache is not None:
+            key = _chapter_key(session, md, encoding)
+            fragment = cache.get(key)
+            args['cache'] = 'miss' if fragment is None else 'hit'
+            if fragment is not None:
+                utils.log.debug(f'cache hit: {md}')
+                return fragment
+
+        fragment = save_fragment(session.render_path(md, encoding))
+        if cache is not None:
+            cache.put(key, fragment, session.renderer.dependencies)
+        return fragment
+
+class RenderError(Exception):
+    '''
+    an error rendering path in a worker process, carried back as text since not every
+    exception raised by the renderer can be pickled
+    '''
+    def __init__(self, message, path):
+        super().__init__(message, path)
+        self.path = path
+
+    def __str__(self):
+        return self.args[0]
+
+def _render_fragment_task(md, *args, **kwargs):
+    # render_fragment in a worker
+    try:
+        return render_fragment(md, *args, **kwargs)
+    except Exception as e:
+        raise RenderError(f'{type(e).__name__}: {e}', md) from e
+
+def _traced_render_fragment(*args, **kwargs):
+    # render_fragment in a worker, the spans it records go back with the fragment
+    utils.trace.start()
+    try:
+        fragment = _render_fragment_task(*args, **kwargs)
+    finally:
+        events = utils.trace.stop()
+    return fragment, events
+
+def _load_traced(result):
+    fragment, events = result
+    utils.trace.add_events(events)
+    return load_fragment(fragment)
+
+def _render_chapter(session, md, encoding, cache):
+    with utils.trace.span('chapter', path=md) as args:
+        if cache is None:
+            return session.render_path(md, encoding)
+
+        key = _chapter_key(session, md, encoding)
+        fragment = cache.get(key)
+        args['cache'] = 'miss' if fragment is None else 'hit'
+        if fragment is not None:
+            utils.log.debug(f'cache hit: {md}')
+            return load_fragment(fragment)
+
+        doc = session.render_path(md, encoding)
+        cache.put(key, save_fragment(doc), session.renderer.dependencies)
+        return doc
+
+def _parallel_renders(mdarg, encoding, jobs, cache, kwargs):
+    # schedule the biggest files first so that a long chapter does not end up
+    # last in the queue, results are still handed back in the original order
+    schedule = sorted(range(len(mdarg)), key=lambda i: os.path.getsize(mdarg[i]), reverse=True)
+    futures = [None] * len(mdarg)
+    if utils.trace.enabled():
+        task, load = _traced_render_fragment, _load_traced
+    else:
+        task, load = _render_fragment_task, load_fragment
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        try:
+            for i in schedule:
+                futures[i] = pool.submit(task, mdarg[i], encoding, cache, **kwargs)
+            for md, fut in zip(mdarg, futures):
+                yield md, lambda fut=fut: load(fut.result())
+        finally:
+            # do not wait for chapters we will never compose
+            for fut in futures:
+                if fut is not None:
+                    fut.cancel()
+
+def _serial_renders(mdarg, encoding, cache, kwargs):
+    with RenderSession(**kwargs) as session:
+        for md in mdarg:
+            yield md, partial(_render_chapter, session, md, encoding, cache)
+
+def _render_into(rdr, md, encoding):
+    with utils.trace.span('chapter', path=md):
+        with open(md, 'r', encoding=encoding) as infile:
+            with utils.trace.span('tokenize'):
+                token = block_token.Document(infile)
+        with utils.trace.span('render'):
+            return rdr.render(token)
+
+def _continuous_renders(mdarg, encoding, kwargs):
+    # every file is rendered into the same document by one renderer
+    with DocxRenderer(continuous=True, **kwargs) as rdr:
+        for md in mdarg:
+            yield md, partial(_render_into, rdr, md, encoding)
+
+def optimize_images(doc, docx_opts, jobs=1, cache=None, extents=None):
+    '''
+    downscale and recompress the images of doc when docx_opts has image_dpi set
+    '''
+    opts = utils.DocxOptions.compile(docx_opts)
+    if opts.image_dpi < 1:
+        return
+    with utils.trace.span('optimize images', dpi=opts.image_dpi) as args:
+        replaced, saved = utils.optimize_images(doc, opts.image_dpi, opts.image_quality, jobs, cache, extents)
+        args.update(replaced=replaced, saved=saved)
+    utils.log.info(f'{replaced} images downscaled/recompressed, {saved} bytes saved')
+
+def precompute_fields(doc, docx_opts):
+    '''
+    write the caption numbers and the table of contents, figures and tables entries of doc
+    when docx_opts has precompute_fields set
+    '''
+    opts = utils.DocxOptions.compile(docx_opts)
+    if not opts.precompute_fields:
+        return
+    with utils.trace.span('precompute fields') as args:
+        counts = utils.precompute_fields(doc)
+        args.update(counts)
+    utils.log.info(f'{counts["captions"]} caption numbers and {counts["entries"]} entries in '
+            f'{counts["tables"]} tables of contents/figures/tables precomputed')
+
+def docx_generate(mdarg, encoding=utils.default_encoding, jobs=1, cache=None, compose=True, **kwargs):
+    '''
+    renders markdown file(s) to a docx, multiple files are composed in the order given
+    jobs determine the number of worker processes used to render the files (0 to use all cores)
+    cache is an optional utils.cache_helper.FragmentCache, unchanged files are loaded from it
+    instead of being rendered again
+    compose=False renders all files into a single document in order instead of composing them,
+    this is faster for many files sharing one template but can't use jobs or cache
+    '''
+    outf = None
+
+    if isinstance(mdarg, list) and len(mdarg) > 0:
+        if jobs is not None and jobs < 1:
+            jobs = os.cpu_count()
+
+        if not compose:
+            if (jobs is not None and jobs > 1) or cache is not None:
+                utils.log.warning('jobs and cache are not used when inputs are not composed')
+            renders = _continuous_renders(mdarg, encoding, kwargs)
+        elif jobs is not None and jobs > 1 and len(mdarg) > 1:
+            renders = _parallel_renders(mdarg, encoding, jobs, cache, kwargs)
+        else:
+            renders = _serial_renders(mdarg, encoding, cache, kwargs)
+
+        md = mdarg[0]
+        try:
+            main_comp = None
+            for md, render in renders:
+                with utils.trace.span('input', path=md):
+                    app_doc = render()
+                    if not compose:
+                        # already rendered into the same document
+                        continue
+                    with utils.trace.span('compose'):
+                        if main_comp is None:
+                            main_comp = Composer(app_doc)
+                        else:
+                            main_comp.append(app_doc)
+
+            outf = app_doc if main_comp is None else main_comp.doc
+        except Exception as e:
+            # if something messes up here, we must raise
+            # this is a fatal error
+            #utils.log.error(f'error on input "{md}" - {e}')
+            utils.log.exception(f'error on input "{md}" - {e}')
+        finally:
+            renders.close()
+            if cache is not None:
+                cache.evict()
+
+    else:
+        outf = render_path(mdarg, encoding, **kwargs)
+
+    if outf is not None:
+        precompute_fields(outf, kwargs.get('docx_opts'))
+        with utils.trace.span('dedupe images'):
+            report_dedupe_images(outf)
+        optimize_images(outf, kwargs.get('docx_opts'), jobs, cache)
+
+    #utils.docx_helper.set_updatefields(outf, 'true')
+    return outf
+
+def _source_lines(src, encoding):
+    # markdown text (str or bytes) or a text/binary file object
+    if hasattr(src, 'read'):
+        src = src.read()
+    if isinstance(src, (bytes, bytearray)):
+        src = bytes(src).decode(encoding)
+    return src.splitlines(keepends=True)
+
+def render_docx(sources, out=None, encoding=utils.default_encoding, compose=True, backend='docx', session=None,
+        **kwargs):
+    '''
+    renders markdown held in memory to a docx, the inputs and output need not be files
+    sources is markdown text (str or bytes), a file object or a list of them, composed in order
+    (or rendered into one document with compose=False, see docx_generate)
+    kwargs go to the renderer: docx_template (a path, the template bytes or a binary file object),
+    rel_root, docx_opts and images, which maps image sources as written in the markdown
+    (e.g., 'figures/net.png') to their bytes. images not in it are read from rel_root
+    the docx is written to out (a path or a binary file object), or returned as bytes if out is None
+    backend='stream' writes the body out while rendering, see stream_generate
+    session is an open RenderSession to render with, its template, rel_root and docx_opts are used
+    instead of those in kwargs and it is left open
+    '''
+    if not isinstance(sources, (list, tuple)):
+        sources = [sources]
+    if len(sources) < 1:
+        raise ValueError('no inputs')
+    target = io.BytesIO() if out is None else out
+
+    if backend == 'stream':
+        with StreamRenderer(target, **kwargs) as rdr:
+            for i, src in enumerate(sources):
+                with utils.trace.span('input', index=i):
+                    rdr.render(block_token.Document(_source_lines(src, encoding)))
+            with utils.trace.span('save'):
+                rdr.save()
+    else:
+        docx_opts = kwargs.get('docx_opts')
+        if compose:
+            owned = session is None
+            if owned:
+                session = RenderSession(**kwargs)
+            else:
+                docx_opts = session.renderer.docx_opts
+            try:
+                main_comp = None
+                for i, src in enumerate(sources):
+                    with utils.trace.span('input', index=i):
+                        app_doc = session.render(_source_lines(src, encoding), kwargs.get('images'))
+                        with utils.trace.span('compose'):
+                            if main_comp is None:
+                                main_comp = Composer(app_doc)
+                            else:
+                                main_comp.append(app_doc)
+            finally:
+                if owned:
+                    session.close()
+            outf = main_comp.doc
+        elif session is not None:
+            docx_opts = session.renderer.docx_opts
+            for i, src in enumerate(sources):
+                with utils.trace.span('input', index=i):
+                    outf = session.render(_source_lines(src, encoding), kwargs.get('images'), carry_on=i > 0)
+        else:
+            with DocxRenderer(continuous=True, **kwargs) as rdr:
+                for i, src in enumerate(sources):
+                    with utils.trace.span('input', index=i):
+                        outf = rdr.render(block_token.Document(_source_lines(src, encoding)))
+
+        precompute_fields(outf, docx_opts)
+        with utils.trace.span('dedupe images'):
+            report_dedupe_images(outf)
+        optimize_images(outf, docx_opts)
+        with utils.trace.span('save'):
+            outf.save(target)
+
+    if out is None:
+        return target.getvalue()
+
+def stream_generate(mdarg, out, encoding=utils.default_encoding, jobs=1, cache=None, **kwargs):
+    '''
+    renders markdown file(s) straight into the docx at out (a path or a binary file object),
+    multiple files are rendered one after another into the same document instead of being composed
+    the document is never held in memory as a whole, use this for very large outputs
+    jobs and cache are only used to process images (image_dpi)
+    '''
+    if not isinstance(mdarg, list):
+        mdarg = [mdarg]
+
+    with StreamRenderer(out, **kwargs) as rdr:
+        for md in mdarg:
+            with utils.trace.span('input', path=md):
+                with open(md, 'r', encoding=encoding) as infile:
+                    with utils.trace.span('tokenize'):
+                        token = block_token.Document(infile)
+                with utils.trace.span('render'):
+                    rdr.render(token)
+        with utils.trace.span('save'):
+            rdr.save(jobs, cache)
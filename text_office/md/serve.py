@@ -0,0 +1,339 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# serve mode, a local http server that renders docx on a pool of warm worker processes
+# only the standard library is used (asyncio), one request per connection
+#
+#   POST /render   json job, answers with the docx
+#       {"markdown": "# title ..." or ["...", "..."],   (composed in order)
+#        "docx_opts": {"image_dpi": "150"},             (optional, on top of the server's -dxopt)
+#        "images": {"figures/net.png": "<base64>"},     (optional, image sources used in the markdown)
+#        "template": "<base64 of a .docx>",             (optional, the server's -t otherwise)
+#        "compose": true}                               (optional, false renders into one document)
+#       a text/markdown body is rendered as is with the server's options
+#   GET /health    json with the queue depth, worker usage and render latencies
+#
+# at most jobs renders run at once and queue_size more wait for a worker, anything beyond is
+# answered with 503. a job that is not done within timeout seconds is answered with 504
+#
+# jobs only read files under the server's rel_root (or use the images they send), a job whose
+# markdown refers to an absolute path or a path out of rel_root is answered with 400
+
+import os
+import json
+import time
+import base64
+import asyncio
+import hashlib
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .. import utils
+from .generate import render_docx
+from .session import RenderSession
+
+DOCX_MIME = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+_reasons = {
+        200: 'OK',
+        400: 'Bad Request',
+        404: 'Not Found',
+        405: 'Method Not Allowed',
+        413: 'Payload Too Large',
+        500: 'Internal Server Error',
+        503: 'Service Unavailable',
+        504: 'Gateway Timeout',
+        }
+
+# latencies kept for /health
+_latency_window = 1000
+
+# templates sent with jobs are kept parsed in each worker, least recently used are dropped
+_max_sessions = 8
+
+# worker process state: server defaults and warm sessions keyed by (template digest, docx_opts)
+_defaults = None
+_sessions = OrderedDict()
+
+def _warm(docx_template, rel_root, docx_opts):
+    # worker initializer, parses the default template and renders once so that imports
+    # and lazily built formatting plans are ready before the first job
+    global _defaults
+    _defaults = (docx_template, rel_root, docx_opts)
+    render_docx('warm up\n', session=_session(None, docx_opts))
+
+def _session(template, docx_opts):
+    docx_template, rel_root, _ = _defaults
+    digest = None if template is None else hashlib.sha256(template).hexdigest()
+    key = (digest, docx_opts)
+    if key in _sessions:
+        _sessions.move_to_end(key)
+        return _sessions[key]
+    session = RenderSession(docx_template if template is None else template, rel_root, docx_opts, confined=True)
+    _sessions[key] = session
+    if len(_sessions) > _max_sessions:
+        _, dropped = _sessions.popitem(last=False)
+        dropped.close()
+    return session
+
+class JobError(Exception):
+    # a job that can't be rendered as sent, raised in a worker (and simple enough to be pickled back)
+    pass
+
+def _render_job(sources, template, docx_opts, images, compose):
+    '''
+    runs in a worker, returns the docx bytes
+    '''
+    session = _session(template, docx_opts)
+    try:
+        return render_docx(sources, session=session, images=images, compose=compose)
+    except Exception as e:
+        # the renderer's own exceptions can't all be pickled, one sent back as is would break the pool
+        raise JobError(f'{type(e).__name__}: {e}') from None
+
+def _ping():
+    return os.getpid()
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class RenderServer:
+    '''
+    renders jobs posted over http with jobs worker processes, started with run()
+    docx_template, rel_root and docx_opts (a dict of option strings) are the defaults of every job,
+    a job can send its own template and docx_opts on top of these
+    '''
+    def __init__(self, host='127.0.0.1', port=8080, jobs=1, queue_size=16, timeout=60,
+            docx_template=None, rel_root=None, docx_opts=None, max_body=64 * 1024 * 1024):
+        self.host = host
+        self.port = port
+        self.jobs = os.cpu_count() if jobs is None or jobs < 1 else jobs
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.docx_template = docx_template
+        self.rel_root = os.path.abspath(os.getcwd() if rel_root is None else rel_root)
+        self.docx_opts = dict(docx_opts or {})
+        self.default_opts = utils.DocxOptions.compile(self.docx_opts)
+        self.max_body = max_body
+        self.pool = None
+        self.workers = None # asyncio.Semaphore, held while a job runs on a worker
+        self.pending = 0 # jobs queued or running
+        self.running = 0
+        self.started = None
+        self.counts = {'completed': 0, 'failed': 0, 'rejected': 0, 'timed_out': 0}
+        self.latencies = deque(maxlen=_latency_window)
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.jobs, initializer=_warm,
+                initargs=(self.docx_template, self.rel_root, self.default_opts))
+
+    async def _start_workers(self):
+        # the pool starts processes as jobs come in, enough concurrent pings start all of them
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.pool, _ping) for _ in range(self.jobs)))
+
+    def parse_job(self, headers, body):
+        '''
+        (sources, template, docx_opts, images, compose) of a request
+        '''
+        ctype = headers.get('content-type', '').split(';')[0].strip().lower()
+        if ctype.startswith('text/'):
+            return [body], None, self.default_opts, None, True
+
+        try:
+            job = json.loads(body)
+            if not isinstance(job, dict) or 'markdown' not in job:
+                raise ValueError('markdown is missing')
+            markdown = job['markdown']
+            sources = [markdown] if isinstance(markdown, str) else list(markdown)
+            if not sources or not all(isinstance(s, str) for s in sources):
+                raise ValueError('markdown must be a string or a list of strings')
+            template = job.get('template')
+            if template is not None:
+                template = base64.b64decode(template, validate=True)
+            images = {src: base64.b64decode(b, validate=True) for src, b in job.get('images', {}).items()}
+            docx_opts = self.default_opts
+            if job.get('docx_opts'):
+                opts = dict(self.docx_opts)
+                opts.update((k, str(v)) for k, v in job['docx_opts'].items())
+                docx_opts = utils.DocxOptions.compile(opts)
+            compose = utils.parse_bool(str(job.get('compose', True)))
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            raise HttpError(400, f'invalid job: {e}')
+        return sources, template, docx_opts, images, compose
+
+    async def _run_job(self, job):
+        loop = asyncio.get_running_loop()
+        await self.workers.acquire()
+        self.running += 1
+        try:
+            fut = self.pool.submit(_render_job, *job)
+        except BaseException:
+            self.running -= 1
+            self.workers.release()
+            raise
+
+        def done(_):
+            # a job that timed out keeps its worker busy until it finishes,
+            # the slot is only freed then
+            self.running -= 1
+            self.workers.release()
+        fut.add_done_callback(lambda f: loop.call_soon_threadsafe(done, f))
+        return await asyncio.shield(asyncio.wrap_future(fut))
+
+    async def render(self, headers, body):
+        if self.pending >= self.jobs + self.queue_size:
+            self.counts['rejected'] += 1
+            raise HttpError(503, f'queue full ({self.queue_size} jobs waiting)')
+
+        job = self.parse_job(headers, body)
+        self.pending += 1
+        t = time.perf_counter()
+        try:
+            docx = await asyncio.wait_for(self._run_job(job), self.timeout)
+        except asyncio.TimeoutError:
+            self.counts['timed_out'] += 1
+            raise HttpError(504, f'job not done within {self.timeout}s')
+        except JobError as e:
+            self.counts['failed'] += 1
+            raise HttpError(400, str(e))
+        except BrokenProcessPool:
+            # a worker died (e.g., killed for memory), start over with a fresh pool
+            self.counts['failed'] += 1
+            utils.log.error('worker process died, restarting the pool')
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = self._new_pool()
+            raise HttpError(500, 'worker process died')
+        except Exception as e:
+            self.counts['failed'] += 1
+            raise HttpError(500, f'{type(e).__name__}: {e}')
+        finally:
+            self.pending -= 1
+
+        ms = (time.perf_counter() - t) * 1000
+        self.latencies.append(ms)
+        self.counts['completed'] += 1
+        return docx, ms
+
+    def health(self):
+        ordered = sorted(self.latencies)
+        latency = {'count': len(ordered)}
+        if ordered:
+            latency.update({
+                'p50_ms': round(_percentile(ordered, 0.5), 1),
+                'p95_ms': round(_percentile(ordered, 0.95), 1),
+                'p99_ms': round(_percentile(ordered, 0.99), 1),
+                'max_ms': round(ordered[-1], 1),
+                })
+        return {
+                'status': 'ok',
+                'uptime_s': round(time.monotonic() - self.started, 1),
+                'workers': self.jobs,
+                'running': self.running,
+                'queued': self.pending - min(self.pending, self.running),
+                'queue_size': self.queue_size,
+                **self.counts,
+                'latency': latency,
+                }
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise HttpError(400, 'malformed request line')
+        method, target, _ = parts
+
+        headers = {}
+        while True:
+            h = await reader.readline()
+            if h in (b'\r\n', b'\n', b''):
+                break
+            k, _, v = h.decode('latin-1').partition(':')
+            headers[k.strip().lower()] = v.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HttpError(400, 'invalid content-length')
+        if length > self.max_body:
+            raise HttpError(413, f'body larger than {self.max_body} bytes')
+        body = await reader.readexactly(length) if length > 0 else b''
+        return method, target.split('?')[0], headers, body
+
+    async def dispatch(self, reader):
+        '''
+        (status, content type, body, extra headers) of the request read from reader
+        '''
+        method, path, headers, body = await asyncio.wait_for(self._read_request(reader), self.timeout)
+        if path == '/health':
+            if method != 'GET':
+                raise HttpError(405, 'use GET')
+            return 200, 'application/json', json.dumps(self.health()).encode(), {}
+        if path == '/render':
+            if method != 'POST':
+                raise HttpError(405, 'use POST')
+            docx, ms = await self.render(headers, body)
+            return 200, DOCX_MIME, docx, {'X-Render-Ms': f'{ms:.1f}'}
+        raise HttpError(404, f'no such path: {path}')
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                status, ctype, body, extra = await self.dispatch(reader)
+            except HttpError as e:
+                status, ctype, body, extra = e.status, 'application/json', json.dumps({'error': str(e)}).encode(), {}
+                if e.status == 503:
+                    extra = {'Retry-After': '1'}
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                return
+
+            head = [f'HTTP/1.1 {status} {_reasons[status]}',
+                    f'Content-Type: {ctype}',
+                    f'Content-Length: {len(body)}',
+                    'Connection: close']
+            head += [f'{k}: {v}' for k, v in extra.items()]
+            writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.pool = self._new_pool()
+        self.workers = asyncio.Semaphore(self.jobs)
+        self.started = time.monotonic()
+        try:
+            await self._start_workers()
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+            utils.log.info(f'serving on http://{self.host}:{self.port} with {self.jobs} workers, press ctrl-c to stop')
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
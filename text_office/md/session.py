@@ -0,0 +1,104 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# a warm render session, keeps the parsed template and the renderer around between renders
+
+import os
+
+from mistletoe import block_token, span_token
+from docx.oxml.ns import qn
+
+from .. import utils
+from ..utils.docx_helper import DocxPrototype
+from .documentx import Renderer as DocxRenderer, image_sources
+
+def _counts(doc):
+    # element counts for the trace
+    body = doc.element.body
+    return {
+            'paragraphs': sum(1 for _ in body.iter(qn('w:p'))),
+            'tables': sum(1 for _ in body.iter(qn('w:tbl'))),
+            'runs': sum(1 for _ in body.iter(qn('w:r'))),
+            }
+
+class RenderSession:
+    '''
+    renders many markdown inputs with the same template/options
+    the template is parsed once and every render gets a fresh copy of it,
+    the custom tokens stay registered with mistletoe until the session is closed
+
+    with RenderSession(docx_template='tpl.docx') as session:
+        for md in inputs:
+            docs.append(session.render_path(md))
+    '''
+    def __init__(self, docx_template=None, rel_root=None, docx_opts=None, images=None, prototype=None, confined=False):
+        # prototype is an already parsed DocxPrototype of docx_template, to share it between sessions
+        # confined (see Renderer) is for markdown that is not trusted
+        self.prototype = DocxPrototype(docx_template) if prototype is None else prototype
+        self.renderer = DocxRenderer(docx_template, rel_root, docx_opts, prototype=self.prototype, images=images,
+                confined=confined)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        # unregisters the custom tokens
+        self.renderer.__exit__(None, None, None)
+
+    def _ensure_tokens(self):
+        # another renderer closing in this process resets mistletoe's global token lists
+        extras = self.renderer._extras
+        if any(t in block_token._token_types for t in extras):
+            return
+        for token in extras:
+            if issubclass(token, span_token.SpanToken):
+                span_token.add_token(token)
+            else:
+                block_token.add_token(token)
+
+    def render(self, infile, images=None, carry_on=False):
+        '''
+        renders markdown lines (e.g., an opened file) or text to a new Document
+        images (see Renderer) are used for this render instead of those the session was made with
+        carry_on renders into the document of the previous render instead (as compose=False does)
+        '''
+        self._ensure_tokens()
+        with utils.trace.span('tokenize'):
+            token = block_token.Document(infile)
+        kept = self.renderer.images
+        if images is not None:
+            self.renderer.images = image_sources(images)
+        self.renderer.continuous = carry_on
+        try:
+            with utils.trace.span('render') as args:
+                doc = self.renderer.render(token)
+                if utils.trace.enabled():
+                    args.update(_counts(doc))
+        finally:
+            self.renderer.images = kept
+            self.renderer.continuous = False
+        return doc
+
+    def render_path(self, md, encoding=utils.default_encoding):
+        with utils.trace.span('read', path=md, bytes=os.path.getsize(md)):
+            with open(md, 'r', encoding=encoding) as infile:
+                # mistletoe makes a list of the lines anyway
+                lines = infile.readlines()
+        return self.render(lines)
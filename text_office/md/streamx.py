@@ -0,0 +1,175 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# streaming docx writer
+# renders like documentx, but every completed top-level block is serialized straight into
+# word/document.xml (spooled to a temporary file) and dropped from the document tree,
+# the body never grows past a single block and the output is written part by part
+
+import re
+import shutil
+import zipfile
+import tempfile
+
+from lxml import etree
+from docx.oxml.ns import qn
+from docx.opc.oxml import serialize_part_xml
+from docx.opc.packuri import CONTENT_TYPES_URI, PACKAGE_URI
+from docx.opc.pkgwriter import _ContentTypesItem
+
+from .. import utils
+from .documentx import Renderer as DocxRenderer
+
+_xmlns_re = re.compile(rb' xmlns:(\w+)="([^"]*)"')
+
+# zip members larger than this need zip64 extensions
+_zip64_limit = zipfile.ZIP64_LIMIT
+
+class Renderer(DocxRenderer):
+    def __init__(self, out, docx_template=None, rel_root=None, docx_opts=None, *extras, prototype=None, images=None):
+        '''
+        renders a .docx using docx_template as the template file, written to out on save()
+        out is a path or a writable binary file object
+        all documents rendered by this renderer are appended into the same output
+        '''
+        super().__init__(docx_template, rel_root, docx_opts, *extras, prototype=prototype, continuous=True,
+                images=images)
+        if self.docx_opts.precompute_fields:
+            # needs the whole document, the body is written out as it renders
+            utils.log.warning('precompute_fields is not used with the stream backend')
+        self.out = out
+        self._spool = None
+        self._shape_id = 0 # largest drawing id already written out
+        self._nsmap = {}
+        self._image_extents = {} # sizes images are shown at in the content already written out
+
+    def new_document(self):
+        super().new_document()
+        self._spool = tempfile.TemporaryFile()
+        self._shape_id = 0
+        self._image_extents = {}
+        self._nsmap = {
+                k.encode(): v.encode() for k, v in self.docx.element.nsmap.items() if k is not None}
+        return self.docx
+
+    def next_shape_id(self, run):
+        if run.part is not self.docx.part:
+            return run.part.next_id
+        return max(run.part.next_id, self._shape_id + 1)
+
+    def render_document(self, token):
+        if self.docx is None:
+            self.new_document()
+
+        for c in token.children:
+            self.render(c)
+            # top-level blocks are done once rendered, write them out
+            self.flush()
+
+        return self.docx
+
+    def _strip_ns(self, xml):
+        # drop the namespace declarations repeated on a serialized body child that are
+        # already declared on the document root
+        end = xml.index(b'>')
+        def _keep(m):
+            return b'' if self._nsmap.get(m.group(1)) == m.group(2) else m.group(0)
+        return _xmlns_re.sub(_keep, xml[:end]) + xml[end:]
+
+    def flush(self, final=False):
+        '''
+        serialize the body content rendered so far to the spool and remove it from the tree
+        '''
+        body = self.docx.element.body
+        children = [c for c in body if c.tag != qn('w:sectPr')] # the body sectPr is written last
+        if not final and children and children[-1].tag in (qn('w:p'), qn('w:tbl')):
+            # the next block can still change the last one: a thematic break or <hr> borders
+            # the current paragraph, a <merge> directly after the table changes it
+            children.pop()
+
+        if self.synthesizer is not None:
+            self.synthesizer.process(children)
+        for child in children:
+            if self.docx_opts.image_dpi > 0:
+                utils.image_extents(child, self.docx.part, self._image_extents)
+            for i in child.xpath('.//@id'):
+                if i.isdigit():
+                    self._shape_id = max(self._shape_id, int(i))
+            self._spool.write(self._strip_ns(etree.tostring(child, encoding='utf-8')))
+            # emptied first, lxml moves a removed subtree into a document of its own node by node
+            child.clear()
+            body.remove(child)
+
+    def render_merge_tag(self, token):
+        if self.table is not None and self.table._tbl.getparent() is None:
+            utils.log.warning('<merge> ignored, it must directly follow the table it merges when streaming')
+            return
+        super().render_merge_tag(token)
+
+    def _document_xml(self):
+        # xml of the document part with the body content left out, split where it goes
+        xml = serialize_part_xml(self.docx.element)
+        if b'<w:body/>' in xml:
+            head, tail = xml.split(b'<w:body/>', 1)
+            return head + b'<w:body>', b'</w:body>' + tail
+        head, tail = xml.split(b'<w:body>', 1)
+        return head + b'<w:body>', tail
+
+    def save(self, jobs=1, cache=None):
+        '''
+        write the docx package to out, same parts as docx.save() would write
+        jobs and cache are used to process images when docx_opts has image_dpi set
+        '''
+        self.flush(final=True)
+        if self.docx_opts.image_dpi > 0:
+            n, saved = utils.optimize_images(self.docx, self.docx_opts.image_dpi,
+                    self.docx_opts.image_quality, jobs, cache, self._image_extents)
+            utils.log.info(f'{n} images downscaled/recompressed, {saved} bytes saved')
+        head, tail = self._document_xml()
+        size = len(head) + self._spool.tell() + len(tail)
+        self._spool.seek(0)
+
+        package = self.docx.part.package
+        parts = package.parts
+        for part in parts:
+            part.before_marshal()
+
+        with zipfile.ZipFile(self.out, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(CONTENT_TYPES_URI.membername, _ContentTypesItem.from_parts(parts).blob)
+            zf.writestr(PACKAGE_URI.rels_uri.membername, package.rels.xml)
+            for part in parts:
+                if part is self.docx.part:
+                    with zf.open(part.partname.membername, 'w', force_zip64=size > _zip64_limit) as f:
+                        f.write(head)
+                        shutil.copyfileobj(self._spool, f)
+                        f.write(tail)
+                else:
+                    zf.writestr(part.partname.membername, part.blob)
+                if len(part._rels):
+                    zf.writestr(part.partname.rels_uri.membername, part._rels.xml)
+
+        self.close()
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self.docx = None
+
+    def __exit__(self, *args):
+        self.close()
+        super().__exit__(*args)
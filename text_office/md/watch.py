@@ -0,0 +1,186 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# watch mode, re-renders the output docx whenever an input, image or template changes
+# uses polling (os.stat) so that no extra dependencies are needed
+
+import os
+import time
+
+from docxcompose.composer import Composer
+
+from .. import utils
+from ..utils.docx_helper import report_dedupe_images
+from .generate import save_fragment, load_fragment, optimize_images, precompute_fields
+from .session import RenderSession
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+class Watcher:
+    '''
+    keeps a render session and the rendered fragment of every input in memory,
+    so that a change only re-renders the inputs affected by it before composing again
+
+    collect is a callable returning the ordered list of inputs, it is called again
+    whenever one of the extra watched paths (e.g., the manifest, input directories) changes
+    '''
+    def __init__(self, collect, output, watched=(), docx_template=None, rel_root=None, docx_opts=None,
+            encoding=utils.default_encoding, interval=0.5, debounce=0.3):
+        self.collect = collect
+        self.output = output
+        self.watched = list(watched)
+        self.docx_template = docx_template
+        self.rel_root = rel_root
+        self.docx_opts = docx_opts
+        self.encoding = encoding
+        self.interval = interval
+        self.debounce = debounce
+        self.session = None
+        self.template_stamp = None
+        self.inlist = []
+        self.fragments = {} # input -> (stamps of the input and its dependencies, fragment)
+
+    def snapshot(self, before=None):
+        '''
+        stamps of the watched paths, those in before (a snapshot taken as a build started) are kept
+        and paths first read by the build get the stamp they had when read, so that a file saved
+        while building differs from the snapshot and is built again
+        '''
+        recorded = {}
+        for stamps, _ in self.fragments.values():
+            recorded.update(stamps)
+        paths = set(self.watched)
+        paths.update(self.inlist)
+        paths.update(recorded)
+        if self.docx_template is not None:
+            paths.add(self.docx_template)
+
+        snap = {}
+        for p in paths:
+            if before is not None and p in before:
+                snap[p] = before[p]
+            elif before is not None and p in recorded:
+                snap[p] = recorded[p]
+            else:
+                snap[p] = _stamp(p)
+        return snap
+
+    def _is_fresh(self, md):
+        if md not in self.fragments:
+            return False
+        stamps, _ = self.fragments[md]
+        return all(_stamp(p) == s for p, s in stamps.items())
+
+    def build(self):
+        tstamp = None if self.docx_template is None else _stamp(self.docx_template)
+        if self.session is None or tstamp != self.template_stamp:
+            # template changed (or first build), everything has to be rendered again
+            if self.session is not None:
+                self.session.close()
+            self.session = RenderSession(self.docx_template, self.rel_root, self.docx_opts)
+            self.template_stamp = tstamp
+            self.fragments = {}
+
+        self.inlist = self.collect()
+        for md in list(self.fragments):
+            if md not in self.inlist:
+                del self.fragments[md]
+
+        rendered = 0
+        failed = 0
+        for md in self.inlist:
+            if self._is_fresh(md):
+                continue
+            stamp = _stamp(md)
+            try:
+                doc = self.session.render_path(md, self.encoding)
+            except Exception as e:
+                # keep rendering the rest, they will be fresh once this input is fixed
+                utils.log.error(f'error on input "{md}" - {e}')
+                self.fragments.pop(md, None)
+                failed += 1
+                continue
+            stamps = {md: stamp}
+            for dep in self.session.renderer.dependencies:
+                stamps[dep] = _stamp(dep)
+            self.fragments[md] = (stamps, save_fragment(doc))
+            rendered += 1
+
+        if failed > 0:
+            utils.log.error(f'{failed} inputs failed, {self.output} not updated')
+            return
+
+        main_comp = None
+        for md in self.inlist:
+            doc = load_fragment(self.fragments[md][1])
+            if main_comp is None:
+                main_comp = Composer(doc)
+            else:
+                main_comp.append(doc)
+
+        if main_comp is None:
+            utils.log.warning('no inputs')
+            return
+
+        precompute_fields(main_comp.doc, self.session.renderer.docx_opts)
+        report_dedupe_images(main_comp.doc)
+        optimize_images(main_comp.doc, self.session.renderer.docx_opts)
+        main_comp.doc.save(self.output)
+        utils.log.info(f'{rendered}/{len(self.inlist)} inputs rendered, docx generated at {self.output}')
+
+    def _try_build(self):
+        try:
+            self.build()
+        except Exception as e:
+            # keep watching, the previous output stays in place
+            utils.log.exception(e)
+
+    def _build(self):
+        # returns the snapshot the next changes are looked for against
+        before = self.snapshot()
+        self._try_build()
+        return self.snapshot(before)
+
+    def run(self):
+        snap = self._build()
+        utils.log.info(f'watching {len(snap)} files for changes, press ctrl-c to stop')
+        try:
+            while True:
+                time.sleep(self.interval)
+                cur = self.snapshot()
+                if cur == snap:
+                    continue
+
+                # debounce: wait for the burst of saves to settle
+                while True:
+                    time.sleep(self.debounce)
+                    nxt = self.snapshot()
+                    if nxt == cur:
+                        break
+                    cur = nxt
+
+                snap = self._build()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.session is not None:
+                self.session.close()
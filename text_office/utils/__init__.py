@@ -17,25 +17,52 @@ Copyright (C) 2023 ToraNova
 
 import os
 import sys
+import importlib
 import traceback
 from .errx_helper import (
         ensure_valid_value,
         ensure_template_file,
+        MissingAttr,
+        InvalidAttr,
+        InvalidValue,
         )
 
 from .log_helper import log
 
-from .path_helper import (
-        boiler_template_path_pip,
-        boiler_template_path,
-        )
+from .path_helper import boiler_template_path
 
-from .parsers import (
-        parse_bool,
-        parse_kv_pairs,
-        parse_sizespec as parse_docx_sizespec,
-        parse_default_args,
-        )
+from . import trace_helper as trace
+
+# helpers that need python-docx, webcolors or cvss (or that only some commands use) are imported on first use (PEP 562),
+# so that commands which render nothing don't pay for them
+_lazy = {
+        'boiler_template_path_pip': ('path_helper', 'boiler_template_path_pip'),
+        'FragmentCache': ('cache_helper', 'FragmentCache'),
+        'iter_data_rows': ('data_helper', 'iter_data_rows'),
+        'DocxOptions': ('option_helper', 'DocxOptions'),
+        'StyleSynthesizer': ('style_helper', 'StyleSynthesizer'),
+        'image_extents': ('image_helper', 'image_extents'),
+        'optimize_images': ('image_helper', 'optimize_images'),
+        'precompute_fields': ('field_helper', 'precompute_fields'),
+        'parse_bool': ('parsers', 'parse_bool'),
+        'parse_kv_pairs': ('parsers', 'parse_kv_pairs'),
+        'parse_docx_sizespec': ('parsers', 'parse_sizespec'),
+        'parse_default_args': ('parsers', 'parse_default_args'),
+        }
+
+_lazy_modules = ('docx_helper', 'vapt_helper', 'parsers', 'option_helper', 'style_helper', 'image_helper',
+        'cache_helper', 'data_helper', 'field_helper')
+
+def __getattr__(name):
+    if name in _lazy:
+        module, attr = _lazy[name]
+        value = getattr(importlib.import_module(f'.{module}', __name__), attr)
+    elif name in _lazy_modules:
+        value = importlib.import_module(f'.{name}', __name__)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
 
 def set_attr_recursively(token, instance_type, attr, value):
     if isinstance(token, instance_type):
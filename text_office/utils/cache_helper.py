@@ -0,0 +1,156 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# on-disk cache of rendered chapter fragments, safe to share between processes
+# each entry is a single file written atomically (write to temp, then rename)
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+from .log_helper import log
+
+default_cache_size = 1024 * 1024 * 1024
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_key(*parts):
+    '''
+    hashes str/bytes parts into a cache key, parts are separated so that ('ab', 'c') != ('a', 'bc')
+    '''
+    h = hashlib.sha256()
+    for p in parts:
+        if isinstance(p, str):
+            p = p.encode('utf-8')
+        h.update(len(p).to_bytes(8, 'little'))
+        h.update(p)
+    return h.hexdigest()
+
+class FragmentCache:
+    '''
+    stores bytes under a key along with the files (dependencies) used to produce them,
+    an entry is only a hit if every dependency still has the same content digest.
+    entries are evicted least-recently-used first once the cache grows beyond max_size bytes
+    '''
+    suffix = '.frag'
+    # temporary files older than this were left behind by a writer that crashed or was killed
+    tmp_grace = 3600
+
+    def __init__(self, cache_dir, max_size=default_cache_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.suffix)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                deps = json.loads(f.readline())
+                blob = f.read()
+        except (FileNotFoundError, ValueError):
+            # missing, evicted by another process or truncated by a crash
+            return None
+
+        for dep, digest in deps.items():
+            try:
+                if file_digest(dep) != digest:
+                    return None
+            except OSError:
+                return None
+
+        try:
+            # mark as recently used
+            os.utime(path)
+        except OSError:
+            pass
+        return blob
+
+    def put(self, key, blob, deps=()):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        header = {}
+        for dep in deps:
+            dep = os.path.abspath(dep)
+            header[dep] = file_digest(dep)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(header).encode('utf-8'))
+                f.write(b'\n')
+                f.write(blob)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def entries(self):
+        '''
+        (mtime, size, path) of every entry and of the stale temporary files
+        '''
+        stale = time.time() - self.tmp_grace
+        out = []
+        for root, _, files in os.walk(self.cache_dir):
+            for fn in files:
+                tmp = fn.endswith('.tmp')
+                if not tmp and not fn.endswith(self.suffix):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, fn))
+                except FileNotFoundError:
+                    continue
+                if tmp and st.st_mtime >= stale:
+                    # still being written
+                    continue
+                out.append((st.st_mtime, st.st_size, os.path.join(root, fn)))
+        return out
+
+    def evict(self):
+        '''
+        removes the stale temporary files, then the least recently used entries until the cache
+        is within max_size, returns the number of files removed
+        '''
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        evicted = 0
+        # stale temporary files first, they are never read
+        for mtime, size, path in sorted(entries, key=lambda e: (not e[2].endswith('.tmp'), e[0])):
+            if total <= self.max_size and not path.endswith('.tmp'):
+                break
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                # another process got to it first
+                pass
+            total -= size
+        if evicted > 0:
+            log.debug(f'cache: evicted {evicted} entries from {self.cache_dir}')
+        return evicted
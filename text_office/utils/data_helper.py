@@ -0,0 +1,98 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# rows of tabular data files (csv, tsv, jsonl), read one at a time
+
+import os
+import csv
+import json
+
+from .errx_helper import InvalidValue
+
+_formats = {
+        '.csv': 'csv',
+        '.tsv': 'tsv',
+        '.tab': 'tsv',
+        '.jsonl': 'jsonl',
+        '.ndjson': 'jsonl',
+        }
+
+def data_format(path, fmt=None):
+    '''
+    fmt, or the format implied by the file extension
+    '''
+    if fmt is None:
+        fmt = _formats.get(os.path.splitext(path)[1].casefold())
+    if fmt not in ('csv', 'tsv', 'jsonl'):
+        raise InvalidValue('format', fmt, ['csv', 'tsv', 'jsonl'])
+    return fmt
+
+def _cell(v):
+    if v is None:
+        return ''
+    if isinstance(v, str):
+        return v
+    return json.dumps(v, ensure_ascii=False)
+
+def _select(rows, header, columns):
+    # keep and reorder the named columns
+    try:
+        idx = [header.index(c) for c in columns]
+    except ValueError as e:
+        raise InvalidValue('columns', ','.join(columns), header) from e
+    yield columns
+    for row in rows:
+        yield [row[i] if i < len(row) else '' for i in idx]
+
+def _delimited_rows(f, delimiter, header, columns):
+    rows = csv.reader(f, delimiter=delimiter)
+    if columns is None:
+        yield from rows
+        return
+    if not header:
+        raise InvalidValue('columns', ','.join(columns), 'requires a header row')
+    first = next(rows, None)
+    if first is not None:
+        yield from _select(rows, first, columns)
+
+def _jsonl_rows(f, header, columns):
+    lines = (l for l in f if l.strip())
+    objs = (json.loads(l) for l in lines)
+    first = next(objs, None)
+    if first is None:
+        return
+    if columns is None:
+        columns = list(first)
+    if header:
+        yield columns
+    yield [_cell(first.get(c)) for c in columns]
+    for o in objs:
+        yield [_cell(o.get(c)) for c in columns]
+
+def iter_data_rows(path, fmt=None, header=True, columns=None, encoding='utf-8'):
+    '''
+    yields the rows of a csv/tsv/jsonl file as lists of strings
+    header tells if a csv/tsv file starts with a header row, jsonl files get a header row made of
+    the keys (columns, or those of the first object) when it is set.
+    columns (list of names) picks and orders the columns, csv/tsv files need a header for it
+    '''
+    fmt = data_format(path, fmt)
+    with open(path, encoding=encoding, newline='') as f:
+        if fmt == 'jsonl':
+            yield from _jsonl_rows(f, header, columns)
+        else:
+            yield from _delimited_rows(f, ',' if fmt == 'csv' else '\t', header, columns)
@@ -15,9 +15,15 @@ Copyright (C) 2023 ToraNova
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
+import io
 import re
+import hashlib
+from copy import deepcopy
+from functools import lru_cache
 from lxml import etree
+from .log_helper import log
 from .errx_helper import (
+        InvalidType,
         ensure_valid_attr,
         ensure_valid_value,
         ensure_and_set,
@@ -25,17 +31,27 @@ from .errx_helper import (
         )
 
 from docx import Document
+from docx.api import _default_docx_path
+from docx.package import Package
+from docx.opc.constants import CONTENT_TYPE as CT, RELATIONSHIP_TYPE as RT
+from docx.opc.package import Unmarshaller
+from docx.opc.part import PartFactory, XmlPart
+from docx.opc.pkgreader import PackageReader
 from docx.table import Table
 from docx.text.paragraph import Paragraph
 from docxcompose.composer import Composer
 from docx.oxml.shared import OxmlElement
 from docx.oxml.ns import qn, nsdecls
 from docx.oxml import parse_xml, CT_P
+from docx.oxml.shape import CT_Inline
+from docx.text.run import Run
+from docx.shape import InlineShape
 from docx.opc.constants import RELATIONSHIP_TYPE
 from docx.oxml.numbering import CT_Num, CT_Numbering, CT_NumPr
 from docx.enum.section import WD_SECTION, WD_ORIENT
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_TAB_ALIGNMENT
 from docx.enum.base import XmlMappedEnumMember, EnumValue
+from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.dml import MSO_THEME_COLOR_INDEX
 from docx.shared import (
         Length, Pt, Inches, Cm, Mm, Twips,
@@ -87,31 +103,79 @@ def merge_table_cells(table, **kwargs):
     merge_tar.merge(table.cell(tr, tc))
     return table
 
-def format_section(section, **kwargs):
-    _optmap = {
-            'left_margin':  ([Length, float], kwargs, section, None, parse_sizespec),
-            'right_margin':  ([Length, float], kwargs, section, None, parse_sizespec),
-            'top_margin':  ([Length, float], kwargs, section, None, parse_sizespec),
-            'bottom_margin':  ([Length, float], kwargs, section, None, parse_sizespec),
-            'page_width':  ([Length, float], kwargs, section, None, parse_sizespec),
-            'page_height':  ([Length, float], kwargs, section, None, parse_sizespec),
-            'orientation': (EnumValue, kwargs, section, None, parse_sec_orientation),
-            'header_distance': ([Length, float], kwargs, section, None, parse_sizespec),
-            'footer_distance': ([Length, float], kwargs, section, None, parse_sizespec),
-            'header_linked': (bool, kwargs, section.header, 'is_linked_to_previous', parse_bool),
-            'footer_linked': (bool, kwargs, section.footer, 'is_linked_to_previous', parse_bool)
-            }
-    ensure_valid_attr(_optmap.keys(), kwargs.keys())
-
-    for k, v in _optmap.items():
-        if v is None:
-            # special cases
-            continue
-        ensure_and_set(k, *v)
+class FormatPlan:
+    '''
+    an attribute set compiled by one of the *_plan functions below: the option values parsed
+    once and grouped by the object they are set on, ready to be applied to any number of elements
+    '''
+    __slots__ = ('sets', 'extra')
+
+    def __init__(self, sets, extra=None):
+        self.sets = sets # ((path of attributes to the target, ((attr, value), ...)), ...)
+        self.extra = extra # what the format function does besides setting attributes
+
+    def apply(self, obj):
+        for path, attrs in self.sets:
+            tar = obj
+            for p in path:
+                tar = getattr(tar, p)
+            for attr, v in attrs:
+                setattr(tar, attr, v)
+        return obj
+
+def _compile_sets(opts, kwargs):
+    # same as ensure_and_set on every option, done once: an option that is not given is still
+    # set when its parser makes a value out of None (e.g., parse_bool -> False)
+    sets = {}
+    for key, vtype, path, attr, parser in opts:
+        v = kwargs.get(key)
+        if parser is not None:
+            v = parser(v)
+        if isinstance(v, vtype):
+            sets.setdefault(path, []).append((attr or key, v))
+        elif v is not None:
+            raise InvalidType(type(v), vtype)
+    return tuple((path, tuple(attrs)) for path, attrs in sets.items())
+
+def _plan(compile_plan, kwargs):
+    # plans are cached by attribute set, unless some value can't be hashed
+    items = tuple(sorted(kwargs.items()))
+    try:
+        hash(items)
+    except TypeError:
+        return compile_plan.__wrapped__(items)
+    return compile_plan(items)
+
+_plan_cache_size = 1024
+
+# option: (key, type, path to the target from the formatted object, attribute (default key), parser)
+_section_opts = (
+        ('left_margin', (Length, float), (), None, parse_sizespec),
+        ('right_margin', (Length, float), (), None, parse_sizespec),
+        ('top_margin', (Length, float), (), None, parse_sizespec),
+        ('bottom_margin', (Length, float), (), None, parse_sizespec),
+        ('page_width', (Length, float), (), None, parse_sizespec),
+        ('page_height', (Length, float), (), None, parse_sizespec),
+        ('orientation', EnumValue, (), None, parse_sec_orientation),
+        ('header_distance', (Length, float), (), None, parse_sizespec),
+        ('footer_distance', (Length, float), (), None, parse_sizespec),
+        ('header_linked', bool, ('header',), 'is_linked_to_previous', parse_bool),
+        ('footer_linked', bool, ('footer',), 'is_linked_to_previous', parse_bool),
+        )
 
+@lru_cache(maxsize=_plan_cache_size)
+def section_plan(items):
+    kwargs = dict(items)
+    ensure_valid_attr([o[0] for o in _section_opts], kwargs.keys())
     # force orientation change by swapping page_width and page_height
-    page_orient = parse_sec_orientation(kwargs.get('orientation'))
-    if isinstance(page_orient, EnumValue):
+    swap = isinstance(parse_sec_orientation(kwargs.get('orientation')), EnumValue)
+    return FormatPlan(_compile_sets(_section_opts, kwargs), swap)
+
+def format_section(section, **kwargs):
+    plan = _plan(section_plan, kwargs)
+    plan.apply(section)
+
+    if plan.extra:
         # force orientation change
         pw = section.page_width
         section.page_width = section.page_height
@@ -119,47 +183,110 @@ def format_section(section, **kwargs):
 
     return section
 
+_run_opts = (
+        ('bold', bool, ('font',), None, parse_bool),
+        ('italic', bool, ('font',), None, parse_bool),
+        ('underline', bool, ('font',), None, parse_bool),
+        ('strike', bool, ('font',), None, parse_bool),
+        ('name', str, ('font',), None, None),
+        ('style', str, (), None, None),
+        ('size', (Length, float), ('font',), None, parse_sizespec),
+        ('color', RGBColor, ('font', 'color'), 'rgb', parse_color),
+        )
+
+def _schema_rank(tag):
+    # child tags of a python-docx element class in schema order, found by letting python-docx
+    # add every child it knows to a scratch element
+    elem = OxmlElement(tag)
+    for name in dir(type(elem)):
+        if name.startswith('get_or_add_'):
+            getattr(elem, name)()
+    return {c.tag: i for i, c in enumerate(elem)}
+
+# w:rPr children in schema order, python-docx inserts them in this order too
+_rpr_rank = _schema_rank('w:rPr')
+
+# how the font setters change an existing w:rPr child: replaced whole (remove then add),
+# or updated in place with the attributes in clear dropped when the new value doesn't have them
+_rpr_replace = {qn('w:u'), qn('w:color')}
+_rpr_clear = {qn('w:b'): (qn('w:val'),), qn('w:i'): (qn('w:val'),), qn('w:strike'): (qn('w:val'),)}
+
+@lru_cache(maxsize=_plan_cache_size)
+def run_plan(items):
+    '''
+    font settings are made once on a scratch run with python-docx, the w:rPr children they produce
+    are then merged into each formatted run directly
+    '''
+    kwargs = dict(items)
+    ensure_valid_attr([o[0] for o in _run_opts], kwargs.keys())
+    sets = _compile_sets(_run_opts, kwargs)
+
+    scratch = Run(OxmlElement('w:r'), None)
+    FormatPlan(tuple(ps for ps in sets if ps[0])).apply(scratch)
+    rPr = scratch._r.rPr
+    props = ()
+    if rPr is not None:
+        props = tuple((c.tag, _rpr_rank.get(c.tag, len(_rpr_rank)), c, c.tag in _rpr_replace,
+            _rpr_clear.get(c.tag, ())) for c in rPr)
+
+    # the style needs the document's styles, it stays a python-docx setter
+    return FormatPlan(tuple(ps for ps in sets if not ps[0]), (rPr, props))
+
+def _merge_rpr(r, proto, props):
+    rPr = r.rPr
+    if rPr is None:
+        r.insert(0, deepcopy(proto))
+        return
+
+    for tag, rank, elem, replace, clear in props:
+        existing = rPr.find(tag)
+        if existing is None:
+            # insert before the first child that comes after it in the schema
+            new = deepcopy(elem)
+            for idx, c in enumerate(rPr):
+                if _rpr_rank.get(c.tag, -1) > rank:
+                    rPr.insert(idx, new)
+                    break
+            else:
+                rPr.append(new)
+        elif replace:
+            rPr.replace(existing, deepcopy(elem))
+        else:
+            for k, v in elem.attrib.items():
+                existing.set(k, v)
+            for k in clear:
+                if k not in elem.attrib:
+                    existing.attrib.pop(k, None)
+
 def format_run(run, **kwargs):
-    _optmap = {
-            'bold':         (bool, kwargs, run.font, None, parse_bool),
-            'italic':       (bool, kwargs, run.font, None, parse_bool),
-            'underline':    (bool, kwargs, run.font, None, parse_bool),
-            'strike':       (bool, kwargs, run.font, None, parse_bool),
-            'name':         (str, kwargs, run.font),
-            'style':        (str, kwargs, run),
-            'size':         ([Length, float], kwargs, run.font, None, parse_sizespec),
-            'color':        (RGBColor, kwargs, run.font.color, 'rgb', parse_color),
-            }
-    ensure_valid_attr(_optmap.keys(), kwargs.keys())
+    plan = _plan(run_plan, kwargs)
+    proto, props = plan.extra
+    if proto is not None:
+        _merge_rpr(run._r, proto, props)
+    return plan.apply(run)
+
+_paragraph_opts = (
+        ('style', str, ('style',), None, None),
+        ('align', EnumValue, ('paragraph_format',), 'alignment', parse_para_align),
+        ('spacing', (Length, float), ('paragraph_format',), 'line_spacing', parse_sizespec),
+        ('before', (Length, float), ('paragraph_format',), 'space_before', parse_sizespec),
+        ('after', (Length, float), ('paragraph_format',), 'space_after', parse_sizespec),
+        ('left_indent', (Length, float), ('paragraph_format',), None, parse_sizespec),
+        ('right_indent', (Length, float), ('paragraph_format',), None, parse_sizespec),
+        ('first_line_indent', (Length, float), ('paragraph_format',), None, parse_sizespec),
+        )
 
-    for k, v in _optmap.items():
-        if v is None:
-            # special cases
-            continue
-        ensure_and_set(k, *v)
-    return run
+@lru_cache(maxsize=_plan_cache_size)
+def paragraph_plan(items):
+    kwargs = dict(items)
+    ensure_valid_attr([o[0] for o in _paragraph_opts] + ['tabstops'], kwargs.keys())
+    return FormatPlan(_compile_sets(_paragraph_opts, kwargs))
 
 def format_paragraph(para, **kwargs):
-    _optmap = {
-            'style': (str, kwargs, para.style),
-            'align': (EnumValue, kwargs, para.paragraph_format, 'alignment', parse_para_align),
-            'spacing': ([Length, float], kwargs, para.paragraph_format, 'line_spacing', parse_sizespec),
-            'before': ([Length, float], kwargs, para.paragraph_format, 'space_before', parse_sizespec),
-            'after': ([Length, float], kwargs, para.paragraph_format, 'space_after', parse_sizespec),
-            'left_indent': ([Length, float], kwargs, para.paragraph_format, None, parse_sizespec),
-            'right_indent': ([Length, float], kwargs, para.paragraph_format, None, parse_sizespec),
-            'first_line_indent': ([Length, float], kwargs, para.paragraph_format, None, parse_sizespec),
-            'tabstops': None,
-            }
-    ensure_valid_attr(_optmap.keys(), kwargs.keys())
+    # tabstops are a list of (position, alignment), applied as given
+    tabstops = kwargs.pop('tabstops', None)
+    _plan(paragraph_plan, kwargs).apply(para)
 
-    for k, v in _optmap.items():
-        if v is None:
-            # special cases
-            continue
-        ensure_and_set(k, *v)
-
-    tabstops = kwargs.get('tabstops')
     if isinstance(tabstops, list):
         for ats in tabstops:
             para.paragraph_format.tab_stops.add_tab_stop(*ats)
@@ -182,40 +309,45 @@ def format_figure(figobj, **kwargs):
         else:
             set_figure_border(figobj, bw)
 
-def format_table(table, **kwargs):
-    _optmap = {
-            'style': (str, kwargs, table),
-            'align': (EnumValue, kwargs, table, 'alignment', parse_table_align),
-            'autofit': (bool, kwargs, table, None, parse_bool),
-            'column_widths': None,
-            'left_indent': None,
-            }
-    ensure_valid_attr(_optmap.keys(), kwargs.keys())
+_table_opts = (
+        ('style', str, (), None, None),
+        ('align', EnumValue, (), 'alignment', parse_table_align),
+        ('autofit', bool, (), None, parse_bool),
+        )
 
-    for k, v in _optmap.items():
-        if v is None:
-            # special cases
-            continue
-        ensure_and_set(k, *v)
+@lru_cache(maxsize=_plan_cache_size)
+def table_plan(items):
+    kwargs = dict(items)
+    ensure_valid_attr([o[0] for o in _table_opts] + ['column_widths', 'left_indent'], kwargs.keys())
 
     colwidths = kwargs.get('column_widths')
-    cwidths=[]
+    cwidths = []
     if isinstance(colwidths, str):
         for cr in colwidths.split(','):
             cwidths.append(parse_sizespec(cr.strip()))
 
+    left_indent = parse_sizespec(kwargs.get('left_indent'))
+    return FormatPlan(_compile_sets(_table_opts, kwargs), (tuple(cwidths), left_indent))
+
+def format_table(table, **kwargs):
+    plan = _plan(table_plan, kwargs)
+    plan.apply(table)
+    cwidths, left_indent = plan.extra
+
     if len(table.columns) >= len(cwidths):
         # if the number cwidths is defined equal or greater to the number of columns
         # then we apply the cwidth manipulation
         table.autofit = False
-        for r in table.rows:
+        # the cells of all rows at once, r.cells would build this list again for every row
+        cells = table._cells
+        ncols = table._column_count
+        for ridx in range(len(table.rows)):
             # apply for every row
-            for idx, cell in enumerate(r.cells):
+            for idx, cell in enumerate(cells[ridx * ncols:(ridx + 1) * ncols]):
                 # apply for every cell in row
                 if idx < len(cwidths):
                     cell.width = cwidths[idx]
 
-    left_indent = parse_sizespec(kwargs.get('left_indent'))
     if left_indent is not None:
         indent_table(table, left_indent)
 
@@ -266,10 +398,48 @@ def format_tabstops(tabstop, cs):
         out.append(vmap[t])
     return out
 
-def insert_hyperlink(para, txt, url):
+class RelationshipIndex:
+    '''
+    external relationships (e.g., hyperlinks) of a part, indexed once by (reltype, target) so that
+    relating a url does not scan every relationship of the part, a url already related is reused
+    new rIds are the smallest free ones, as python-docx picks them
+    '''
+    def __init__(self, part):
+        self.rels = part.rels
+        self.external = {(rel.reltype, rel.target_ref): rId for rId, rel in self.rels.items() if rel.is_external}
+        self.next_id = 1
+
+    def relate_to(self, target, reltype=RELATIONSHIP_TYPE.HYPERLINK):
+        key = (reltype, target)
+        rId = self.external.get(key)
+        if rId is None:
+            while f'rId{self.next_id}' in self.rels:
+                self.next_id += 1
+            rId = f'rId{self.next_id}'
+            self.rels.add_relationship(reltype, target, rId, is_external=True)
+            self.external[key] = rId
+        return rId
+
+def character_style_id(doc, name):
+    '''
+    style id of the character style called name in doc, None if there is none
+    '''
+    style = doc.styles.element.get_by_name(name)
+    if style is None or style.type != WD_STYLE_TYPE.CHARACTER:
+        return None
+    return style.styleId
+
+def insert_hyperlink(para, txt, url, rels=None, style_id=None):
+    '''
+    adds a link to url showing txt at the end of para
+    rels is the RelationshipIndex of para's part (the part is searched for url otherwise),
+    style_id a character style for the link (e.g., the template's Hyperlink), direct formatting otherwise
+    '''
     # This gets access to the document.xml.rels file and gets a new relation id value
-    part = para.part
-    r_id = part.relate_to(url, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
+    if rels is None:
+        r_id = para.part.relate_to(url, RELATIONSHIP_TYPE.HYPERLINK, is_external=True)
+    else:
+        r_id = rels.relate_to(url)
 
     # Create the w:hyperlink tag and add needed values
     hyperlink = OxmlElement('w:hyperlink')
@@ -288,8 +458,11 @@ def insert_hyperlink(para, txt, url):
     r = para.add_run()
     r._r.append(hyperlink)
 
+    if style_id is not None:
+        r._r.get_or_add_rPr().style = style_id
+        return hyperlink
+
     # A workaround for the lack of a hyperlink style (doesn't go purple after using the link)
-    # Delete this if using a template that has the hyperlink style in it
     r.font.color.theme_color = MSO_THEME_COLOR_INDEX.HYPERLINK
     #r.font.color.rgb = RGBColor(0x06, 0x45, 0xad)
     r.font.underline = True
@@ -310,6 +483,79 @@ def assign_numbering(doc, para, anid, start=1, tierlvl=0):
     para._p.get_or_add_pPr().get_or_add_numPr().get_or_add_numId().val = nxtnid
     return nxtnid
 
+class NumberingAllocator:
+    '''
+    restarts the numbering of lists in doc, each restarted list gets a w:num (numId) of its own
+    numbering.xml is indexed once, so numIds are handed out without scanning every w:num
+    (the smallest free one, as python-docx does) and new w:num are added after the last one
+    the abstractNum of a list style is found through the template: style numPr -> numId -> abstractNumId
+    '''
+    def __init__(self, doc):
+        self.doc = doc
+        self.numbering = doc.part.numbering_part.element
+        nums = self.numbering.num_lst
+        self.abstract_of = {n.numId: n.abstractNumId.val for n in nums} # numId -> abstractNumId
+        self.last = nums[-1] if nums else None
+        self.next_id = 1
+        self.styles = {} # style name -> (abstractNumId, ilvl) or None
+        self.overrides = {} # (abstractNumId, ilvl, start) -> w:num copied for every restart
+
+    def style_numbering(self, style_name):
+        '''
+        (abstractNumId, ilvl) the paragraph style numbers its paragraphs with, None if it does not
+        '''
+        if style_name not in self.styles:
+            self.styles[style_name] = self._find(style_name)
+        return self.styles[style_name]
+
+    def _find(self, style_name):
+        try:
+            style = self.doc.styles[style_name]
+        except KeyError:
+            return None
+        while style is not None:
+            # the numbering may come from a base style
+            pPr = style.element.pPr
+            numPr = pPr.numPr if pPr is not None else None
+            if numPr is not None and numPr.numId is not None:
+                anid = self.abstract_of.get(numPr.numId.val)
+                if anid is None:
+                    return None
+                return anid, numPr.ilvl.val if numPr.ilvl is not None else 0
+            style = style.base_style
+        return None
+
+    def restart(self, para, style_name, start=1):
+        '''
+        numbers para (the first paragraph of a list in style_name) from start,
+        returns the numId assigned or None if the style has no numbering to restart
+        '''
+        found = self.style_numbering(style_name)
+        if found is None:
+            return None
+        anid, ilvl = found
+
+        while self.next_id in self.abstract_of:
+            self.next_id += 1
+        numId = self.next_id
+
+        key = (anid, ilvl, start)
+        if key not in self.overrides:
+            proto = CT_Num.new(numId, anid)
+            proto.add_lvlOverride(ilvl=ilvl).add_startOverride(start)
+            self.overrides[key] = proto
+        num = deepcopy(self.overrides[key])
+        num.numId = numId
+
+        if self.last is None:
+            self.numbering._insert_num(num)
+        else:
+            self.last.addnext(num)
+        self.last = num
+        self.abstract_of[numId] = anid
+        para._p.get_or_add_pPr().get_or_add_numPr().get_or_add_numId().val = numId
+        return numId
+
 def set_paranumpr(para, numid=3, ilvl=0):
     npr = para._p.get_or_add_pPr().get_or_add_numPr()
     npr.get_or_add_numId().val = numid
@@ -349,22 +595,115 @@ def make_caption(run, include_heading=0, caption_type='Figure'):
     fldChar.set(qn('w:fldCharType'), 'end')
     r.append(fldChar)
 
+def add_picture(run, img_path, cache, shape_id=None, filename=None):
+    '''
+    same as run.add_picture(img_path), but the image is read and hashed only once per
+    document part, cache is a dict kept by the caller for the lifetime of the document
+    img_path is a path or a binary file object, filename names the picture (default: that of the file)
+    shape_id defaults to the next free id in the part
+    '''
+    part = run.part
+    key = (part.partname, img_path)
+    if key not in cache:
+        cache[key] = part.get_or_add_image(img_path)
+    rId, image = cache[key]
+    cx, cy = image.scaled_dimensions(None, None)
+    if shape_id is None:
+        shape_id = part.next_id
+    inline = CT_Inline.new_pic_inline(shape_id, rId, filename or image.filename, cx, cy)
+    run._r.add_drawing(inline)
+    return InlineShape(inline)
+
+_image_ref_ns = {
+        'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+        'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
+        'v': 'urn:schemas-microsoft-com:vml',
+        }
+
+_image_ref_attrs = (
+        (etree.XPath('.//a:blip[@r:embed]', namespaces=_image_ref_ns), qn('r:embed')),
+        (etree.XPath('.//a:blip[@r:link]', namespaces=_image_ref_ns), qn('r:link')),
+        (etree.XPath('.//v:imagedata[@r:id]', namespaces=_image_ref_ns), qn('r:id')),
+        )
+
+def dedupe_images(doc):
+    '''
+    keys every image in the package by its content hash, so that each distinct image is
+    stored once and all references (body, headers, footers) point at that one part
+    returns (distinct images, references, image parts removed, bytes of the parts removed)
+    python-docx and docxcompose already store an image once per part they add it to, so usually
+    nothing is removed
+    '''
+    package = doc.part.package
+    canon = {}
+    digests = {}
+    replaced = {} # id -> duplicate image part no longer referenced from the relinked elements
+    refs = 0
+    for part in list(package.iter_parts()):
+        if not isinstance(part, XmlPart):
+            continue
+
+        dropped = set()
+        for xp, attr in _image_ref_attrs:
+            for el in xp(part.element):
+                rId = el.get(attr)
+                rel = part.rels.get(rId)
+                if rel is None or rel.is_external:
+                    continue
+                target = rel.target_part
+                if id(target) not in digests:
+                    digests[id(target)] = hashlib.sha1(target.blob).hexdigest()
+                digest = digests[id(target)]
+                refs += 1
+
+                first = canon.setdefault(digest, target)
+                if first is not target:
+                    el.set(attr, part.relate_to(first, rel.reltype))
+                    dropped.add(rId)
+                    replaced[id(target)] = target
+
+        for rId in dropped:
+            part.drop_rel(rId)
+
+    if not replaced:
+        return len(canon), refs, 0, 0
+
+    # a duplicate is only gone from the saved package once nothing relates to it any more
+    referenced = {id(rel.target_part) for rel in package.rels.values() if not rel.is_external}
+    for part in package.iter_parts():
+        referenced.update(id(rel.target_part) for rel in part.rels.values() if not rel.is_external)
+    removed = [p for k, p in replaced.items() if k not in referenced]
+    return len(canon), refs, len(removed), sum(len(p.blob) for p in removed)
+
 def delete_paragraph(para):
     p = para._element
     p.getparent().remove(p)
     p._p = p._element = None
 
-def format_cell(cell, **kwargs):
+@lru_cache(maxsize=_plan_cache_size)
+def cell_plan(items):
+    kwargs = dict(items)
+    shd = None
     if 'color' in kwargs:
+        # w:shd prototype, copied into every cell
         color = parse_color(kwargs.pop('color'))
-        sh_elem = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), color))
-        cell._tc.get_or_add_tcPr().append(sh_elem)
+        shd = parse_xml(r'<w:shd {} w:fill="{}"/>'.format(nsdecls('w'), color))
 
+    align = None
     if 'align' in kwargs:
-        align = kwargs.pop('align')
+        align = _plan(paragraph_plan, {'align': kwargs.pop('align')})
+
+    return FormatPlan((), (shd, align, _plan(border_plan, kwargs)))
+
+def format_cell(cell, **kwargs):
+    shd, align, border = _plan(cell_plan, kwargs).extra
+
+    if shd is not None:
+        cell._tc.get_or_add_tcPr().append(deepcopy(shd))
+
+    if align is not None:
         for para in cell.paragraphs:
-            ikwargs = {'align': align}
-            format_paragraph(para, **ikwargs)
+            align.apply(para)
 
     tc = cell._tc
     tcPr = tc.get_or_add_tcPr()
@@ -375,7 +714,7 @@ def format_cell(cell, **kwargs):
         tcBorders = OxmlElement('w:tcBorders')
         tcPr.append(tcBorders)
 
-    set_border(tcBorders, **kwargs)
+    _apply_border(tcBorders, border)
 
     return cell
 
@@ -440,9 +779,15 @@ def concat_docx(files):
         for f in files[1:]:
             main_c.append(Document(f))
 
+        report_dedupe_images(main_c.doc)
         return main_c.doc
     raise TypeError('input to concat_docx should be a list')
 
+def report_dedupe_images(doc):
+    distinct, refs, removed, saved = dedupe_images(doc)
+    if removed > 0:
+        log.info(f'{removed} duplicate images removed ({saved} bytes), {refs} image references point at {distinct} distinct images')
+
 def set_updatefields(docx, val="true"):
     # https://github.com/elapouya/python-docx-template/issues/151#issuecomment-442722594
     namespace = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
@@ -545,6 +890,26 @@ def format_table_border(table, **kwargs):
     return table
 
 
+def table_column_widths(table, column_widths):
+    '''
+    the cell widths format_table(table, column_widths=column_widths) gives each row, empty if
+    it leaves the widths alone
+    '''
+    cwidths = _plan(table_plan, {'column_widths': column_widths}).extra[0]
+    if len(table.columns) >= len(cwidths):
+        return cwidths
+    return ()
+
+def add_text_run(p, text):
+    '''
+    append a run with text to the w:p element, same as p.add_r().text = text
+    '''
+    if text.strip() != text or '\t' in text or '\n' in text or '\r' in text:
+        # tabs and line breaks are elements of their own, outer spaces need xml:space
+        p.add_r().text = text
+        return
+    etree.SubElement(etree.SubElement(p, qn('w:r')), qn('w:t')).text = text
+
 def indent_table(table, indent):
     # noinspection PyProtectedMember
     tbl_pr = table._element.xpath('w:tblPr')
@@ -555,48 +920,36 @@ def indent_table(table, indent):
         tbl_pr[0].append(e)
 
 
-def set_border(tbem, **kwargs):
-    _edgemap = ('left', 'right', 'top', 'bottom', 'insideH', 'insideV')
-    _typemap = ('width', 'line', 'color', 'space', 'shadow')
-    _defaults = {
-            'width': '12',
-            'color': '000000',
-            'line': 'single',
-            'space': '0',
-            'shadow': 'false',
-            }
-
-    _optmap = []
-    for e in _edgemap:
-        for t in _typemap:
-            _optmap.append('%s_%s' % (e, t))
-
-    ensure_valid_attr(_optmap, kwargs.keys())
+_edgemap = ('left', 'right', 'top', 'bottom', 'insideH', 'insideV')
+_typemap = ('width', 'line', 'color', 'space', 'shadow')
+_border_defaults = {
+        'width': '12',
+        'color': '000000',
+        'line': 'single',
+        'space': '0',
+        'shadow': 'false',
+        }
+_border_opts = ['%s_%s' % (e, t) for e in _edgemap for t in _typemap]
+
+@lru_cache(maxsize=_plan_cache_size)
+def border_plan(items):
+    kwargs = dict(items)
+    ensure_valid_attr(_border_opts, kwargs.keys())
     submap = {
         'width': 'sz',
         'line': 'val',
     }
 
     # search for edge options, if any edge options exists, all types should be configured
+    edges = []
     for e in _edgemap:
-        edge_undefined = True
-        for opt in kwargs.keys():
-            if opt.startswith(e):
-                # one of the types on this edge is defined
-                edge_undefined = False
-                break
-
-        if edge_undefined:
+        if not any(opt.startswith(e) for opt in kwargs.keys()):
             # skip the rest
             continue
 
+        attrs = []
         for t in _typemap:
-            _key = '%s_%s' % (e, t)
-
-            if _key in kwargs:
-                edat = kwargs.pop(_key)
-            else:
-                edat = _defaults[t]
+            edat = kwargs.get('%s_%s' % (e, t), _border_defaults[t])
 
             if t == 'width':
                 if edat.endswith('pt'):
@@ -607,24 +960,72 @@ def set_border(tbem, **kwargs):
                 if not edat.startswith('#'):
                     edat = '#%s' % edat
 
-            if t in submap:
-                t = submap[t]
-
-            # check tag existence, if does not exist, create one
-            tag = 'w:%s' % e
-            element = tbem.find(qn(tag))
+            attrs.append((qn('w:%s' % submap.get(t, t)), edat))
+        edges.append(('w:%s' % e, tuple(attrs)))
 
-            if element is None:
-                # element does not exist, create one
-                element = OxmlElement(tag)
-                tbem.append(element)
-
-            element.set(qn('w:%s' % t), edat)
+    return FormatPlan((), tuple(edges))
 
+def _apply_border(tbem, plan):
+    for tag, attrs in plan.extra:
+        # check tag existence, if does not exist, create one
+        element = tbem.find(qn(tag))
+        if element is None:
+            element = OxmlElement(tag)
+            tbem.append(element)
+        for attr, edat in attrs:
+            element.set(attr, edat)
     return tbem
 
+def set_border(tbem, **kwargs):
+    return _apply_border(tbem, _plan(border_plan, kwargs))
+
 def left_indent_from_level(obj, lvl, indent_p_lvl=Inches(0.4)):
     if isinstance(obj, Paragraph):
         obj.paragraph_format.left_indent = indent_p_lvl * lvl
     elif isinstance(obj, Table):
         indent_table(obj, Twips(indent_p_lvl.twips * lvl))
+
+
+class DocxPrototype:
+    '''
+    a .docx template that is read and parsed once, new_document() hands out fresh copies
+    the unzipped parts are kept as bytes and xml parts are kept parsed, so each copy
+    only needs to deepcopy the xml trees instead of re-reading the whole package
+    docx_template is a path, the bytes of a .docx or a binary file object
+    '''
+    def __init__(self, docx_template=None):
+        if docx_template is None:
+            docx_template = _default_docx_path()
+        if isinstance(docx_template, (bytes, bytearray)):
+            self.blob = bytes(docx_template)
+            docx_template = '<bytes>'
+        elif hasattr(docx_template, 'read'):
+            self.blob = docx_template.read()
+            docx_template = getattr(docx_template, 'name', '<stream>')
+        else:
+            with open(docx_template, 'rb') as tfile:
+                self.blob = tfile.read()
+        self.docx_template = docx_template
+        self.digest = hashlib.sha256(self.blob).hexdigest()
+        self._reader = PackageReader.from_file(io.BytesIO(self.blob))
+        self._elements = {}
+        for partname, content_type, reltype, blob in self._reader.iter_sparts():
+            if reltype == RT.IMAGE:
+                continue
+            if issubclass(PartFactory._part_cls_for(content_type), XmlPart):
+                self._elements[partname] = parse_xml(blob)
+
+    def _make_part(self, partname, content_type, reltype, blob, package):
+        element = self._elements.get(partname)
+        if element is None:
+            return PartFactory(partname, content_type, reltype, blob, package)
+        part_cls = PartFactory._part_cls_for(content_type)
+        return part_cls(partname, content_type, deepcopy(element), package)
+
+    def new_document(self):
+        package = Package()
+        Unmarshaller.unmarshal(self._reader, package, self._make_part)
+        document_part = package.main_document_part
+        if document_part.content_type != CT.WML_DOCUMENT_MAIN:
+            raise ValueError(f'file \'{self.docx_template}\' is not a Word file, content type is \'{document_part.content_type}\'')
+        return document_part.document
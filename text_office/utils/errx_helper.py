@@ -16,10 +16,7 @@ Copyright (C) 2023 ToraNova
 '''
 
 import os
-from .path_helper import (
-        boiler_template_path,
-        boiler_template_path_pip,
-        )
+from . import path_helper
 
 from .log_helper import log
 
@@ -101,10 +98,10 @@ def ensure_template_file(t, auto_add_suffix=None):
 
     if not os.path.isfile(tplfn):
         log.warn(f"cannot find boiler template '{tplfn}' in current working directory, defaulting to built-ins")
-        tplfn = os.path.join(boiler_template_path, btplfn)
+        tplfn = os.path.join(path_helper.boiler_template_path, btplfn)
 
     if not os.path.isfile(tplfn):
-        tplfn = os.path.join(boiler_template_path_pip, btplfn)
+        tplfn = os.path.join(path_helper.boiler_template_path_pip, btplfn)
 
     if not os.path.isfile(tplfn):
         raise FileExistsError(f"cannot find boiler template '{btplfn}' in built-in templates dir")
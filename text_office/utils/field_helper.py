@@ -0,0 +1,309 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# field results computed from the finished document, so that it reads right before word updates
+# its fields: caption numbers (SEQ and the STYLEREF chapter prefix) and the entries of tables of
+# contents, figures and tables (TOC), which link to bookmarks put on the headings and captions
+#
+# page numbers need the document laid out, the PAGEREF fields of the entries are left without
+# a result. headings count as numbered 1, 1.1, 1.1.1 ... for the chapter prefix of captions
+
+import re
+
+from docx.enum.style import WD_STYLE_TYPE
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.shared import Pt
+
+_heading_re = re.compile(r'^heading ([1-9])$')
+_seq_re = re.compile(r'^\s*SEQ\s+(\S+)(.*)$')
+_styleref_re = re.compile(r'^\s*STYLEREF\s+"?([1-9])"?')
+_toc_re = re.compile(r'^\s*TOC\b(.*)$')
+_switch_re = re.compile(r'\\([a-z])(?:\s+"([^"]*)"|\s+([^\\\s"]+))?')
+
+# what word writes in a table that has no entries
+_no_entries = {
+        'TOC': 'No table of contents entries found.',
+        'TOF': 'No table of figures entries found.',
+        }
+
+_t = qn('w:t')
+_tab = qn('w:tab')
+_nbh = qn('w:noBreakHyphen')
+_fldChar = qn('w:fldChar')
+_instrText = qn('w:instrText')
+_fldCharType = qn('w:fldCharType')
+
+def _switches(instr):
+    return {m.group(1): m.group(2) if m.group(2) is not None else m.group(3) for m in _switch_re.finditer(instr)}
+
+def _text(p):
+    # visible text of a paragraph, field instructions left out
+    out = []
+    for e in p.iter(_t, _tab, _nbh):
+        if e.tag == _t:
+            out.append(e.text or '')
+        elif e.tag == _tab:
+            out.append(' ')
+        else:
+            out.append('\u2011')
+    return ''.join(out).strip()
+
+def _fields(p):
+    '''
+    complex fields of a paragraph: [instruction, begin, separate or None, end]
+    '''
+    stack = []
+    for e in p.iter(_fldChar, _instrText):
+        if e.tag == _instrText:
+            if stack:
+                stack[-1][0] += e.text or ''
+            continue
+        kind = e.get(_fldCharType)
+        if kind == 'begin':
+            stack.append(['', e, None, None])
+        elif kind == 'separate' and stack:
+            stack[-1][2] = e
+        elif kind == 'end' and stack:
+            field = stack.pop()
+            field[3] = e
+            yield field
+
+def _set_result(field, text):
+    # only fields rendered without a result (e.g., by make_caption) get one
+    _, _, separate, end = field
+    if separate is not None:
+        return False
+    separate = OxmlElement('w:fldChar')
+    separate.set(_fldCharType, 'separate')
+    t = OxmlElement('w:t')
+    t.set(qn('xml:space'), 'preserve')
+    t.text = text
+    end.addprevious(separate)
+    end.addprevious(t)
+    return True
+
+def _run(*children):
+    r = OxmlElement('w:r')
+    for c in children:
+        r.append(c)
+    return r
+
+def _fld_char(kind):
+    e = OxmlElement('w:fldChar')
+    e.set(_fldCharType, kind)
+    return e
+
+def _instr(text):
+    e = OxmlElement('w:instrText')
+    e.set(qn('xml:space'), 'preserve')
+    e.text = text
+    return e
+
+def _text_run(text):
+    t = OxmlElement('w:t')
+    t.set(qn('xml:space'), 'preserve')
+    t.text = text
+    return _run(t)
+
+class FieldPrecomputer:
+    '''
+    computes the fields of doc's body in one pass over it, see precompute()
+    '''
+    def __init__(self, doc):
+        self.doc = doc
+        self.body = doc.element.body
+        self.styles = doc.styles.element
+        self.heading_levels = {}
+        for s in self.styles.style_lst:
+            m = _heading_re.match((s.name_val or '').lower())
+            if m and s.type == WD_STYLE_TYPE.PARAGRAPH:
+                self.heading_levels[s.styleId] = int(m.group(1))
+
+        self.bookmark_names = set()
+        self.bookmark_id = 0
+        for b in self.body.iter(qn('w:bookmarkStart')):
+            self.bookmark_names.add(b.get(qn('w:name')))
+            try:
+                self.bookmark_id = max(self.bookmark_id, int(b.get(qn('w:id'))))
+            except (TypeError, ValueError):
+                pass
+        self.bookmarks = {} # paragraph -> bookmark name
+        self.next_toc = 1
+
+        self.headings = [] # (level, paragraph)
+        self.captions = {} # sequence name -> paragraphs
+        self.tocs = [] # (switches, field, paragraph)
+        self.counts = {'captions': 0, 'tables': 0, 'entries': 0}
+
+    def precompute(self):
+        '''
+        fills in the results of the caption fields and the entries of the TOC fields of the body,
+        returns counts of what was filled in
+        '''
+        chapter = [0] * 10 # heading numbers by level, 1 based
+        serial = [0] * 10 # a number changed by every heading at this level or above
+        seqs = {} # name -> (count, serial it counts under)
+        headings = 0
+
+        for p in self.body.iter(qn('w:p')):
+            level = self.heading_levels.get(p.style)
+            if level is not None:
+                headings += 1
+                chapter[level] += 1
+                for lvl in range(level + 1, 10):
+                    chapter[lvl] = 0
+                for lvl in range(level, 10):
+                    serial[lvl] = headings
+                self.headings.append((level, p))
+
+            seq = None
+            for field in _fields(p):
+                instr = field[0]
+                m = _seq_re.match(instr)
+                if m:
+                    name, switches = m.group(1), _switches(m.group(2))
+                    reset = switches.get('s')
+                    under = serial[int(reset)] if reset and reset.isdigit() and 0 < int(reset) < 10 else 0
+                    count, counted_under = seqs.get(name, (0, under))
+                    count = count + 1 if counted_under == under else 1
+                    seqs[name] = (count, under)
+                    if _set_result(field, str(count)):
+                        self.counts['captions'] += 1
+                    if seq is None:
+                        seq = name
+                    continue
+                m = _styleref_re.match(instr)
+                if m:
+                    lvl = int(m.group(1))
+                    _set_result(field, '.'.join(str(c) for c in chapter[1:lvl + 1]))
+                    continue
+                m = _toc_re.match(instr)
+                if m:
+                    self.tocs.append((_switches(m.group(1)), field, p))
+            if seq is not None:
+                self.captions.setdefault(seq, []).append(p)
+
+        for switches, field, p in self.tocs:
+            self.fill_toc(switches, field, p)
+        return self.counts
+
+    def bookmark(self, p):
+        name = self.bookmarks.get(p)
+        if name is not None:
+            return name
+        while True:
+            name = f'_Toc{self.next_toc:09d}'
+            self.next_toc += 1
+            if name not in self.bookmark_names:
+                break
+        self.bookmark_names.add(name)
+        self.bookmark_id += 1
+        start = OxmlElement('w:bookmarkStart')
+        start.set(qn('w:id'), str(self.bookmark_id))
+        start.set(qn('w:name'), name)
+        end = OxmlElement('w:bookmarkEnd')
+        end.set(qn('w:id'), str(self.bookmark_id))
+        if p.pPr is not None:
+            p.pPr.addnext(start)
+        else:
+            p.insert(0, start)
+        p.append(end)
+        self.bookmarks[p] = name
+        return name
+
+    def style_id(self, name, indent=0):
+        # word adds the toc styles it uses on update, do the same for templates without them
+        style = self.styles.get_by_name(name)
+        if style is None:
+            added = self.doc.styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+            added.base_style = self.doc.styles['Normal']
+            added.paragraph_format.left_indent = Pt(indent)
+            added.paragraph_format.space_after = Pt(5 if name.startswith('toc') else 0)
+            return added.style_id
+        return style.styleId
+
+    def entry(self, p, style_id, hyperlink):
+        name = self.bookmark(p)
+        para = OxmlElement('w:p')
+        pPr = OxmlElement('w:pPr')
+        pStyle = OxmlElement('w:pStyle')
+        pStyle.set(qn('w:val'), style_id)
+        pPr.append(pStyle)
+        para.append(pPr)
+
+        tab = OxmlElement('w:tab')
+        runs = [_text_run(_text(p)), _run(tab),
+                _run(_fld_char('begin')), _run(_instr(f' PAGEREF {name} \\h ')),
+                _run(_fld_char('separate')), _run(_fld_char('end'))]
+        if hyperlink:
+            link = OxmlElement('w:hyperlink')
+            link.set(qn('w:anchor'), name)
+            link.set(qn('w:history'), '1')
+            for r in runs:
+                link.append(r)
+            para.append(link)
+        else:
+            for r in runs:
+                para.append(r)
+        return para
+
+    def fill_toc(self, switches, field, p):
+        _, begin, separate, end = field
+        if separate is None:
+            return
+        if 'c' in switches:
+            kind = 'TOF'
+            style_id = self.style_id('table of figures')
+            entries = [self.entry(c, style_id, 'h' in switches) for c in self.captions.get(switches['c'], [])]
+        else:
+            kind = 'TOC'
+            low, _, high = (switches.get('o') or '1-9').partition('-')
+            low, high = int(low), int(high or low)
+            style_ids = {}
+            entries = []
+            for level, h in self.headings:
+                if low <= level <= high:
+                    if level not in style_ids:
+                        style_ids[level] = self.style_id(f'toc {level}', 11 * (level - 1))
+                    entries.append(self.entry(h, style_ids[level], 'h' in switches))
+
+        # the old result (a placeholder) goes, the entries are the new one
+        for c in list(separate):
+            separate.remove(c)
+        run = end.getparent()
+        if not entries:
+            end.addprevious(_text_run(_no_entries[kind])[0])
+            self.counts['tables'] += 1
+            return
+
+        # the field now ends in the paragraph of the last entry
+        run.remove(end)
+        last = p
+        for e in entries:
+            last.addnext(e)
+            last = e
+        last.append(_run(end))
+        self.counts['tables'] += 1
+        self.counts['entries'] += len(entries)
+
+def precompute_fields(doc):
+    '''
+    writes the results of the caption number fields and the entries of the tables of contents,
+    figures and tables of doc (a whole document, after composing), returns counts of what was written
+    '''
+    return FieldPrecomputer(doc).precompute()
@@ -0,0 +1,208 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# embedded images downscaled to the size they are displayed at and recompressed
+# needs Pillow, without it images are embedded as they are
+
+import io
+import os
+import math
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from docx.opc.constants import CONTENT_TYPE as CT
+from docx.opc.packuri import PackURI
+from docx.oxml.ns import qn
+from docx.shared import Inches
+
+from .log_helper import log
+from .cache_helper import make_key
+
+try:
+    import PIL
+    from PIL import Image
+except ImportError:
+    PIL = None
+
+# images with more colors than this and no transparency are taken to be photos, and stored as jpeg
+# screenshots and diagrams stay png, jpeg smears their text and edges
+_photo_colors = 1 << 16
+
+_formats = {
+        'png': CT.PNG,
+        'jpeg': CT.JPEG,
+        }
+
+_drawing_tags = (qn('wp:inline'), qn('wp:anchor'))
+
+# python-docx has no prefix for vml, qn('v:...') only works once docxcompose has added it
+_vml_imagedata = '{urn:schemas-microsoft-com:vml}imagedata'
+
+def image_extents(element, part, extents):
+    '''
+    records in extents the largest size (cx, cy in EMU) each image part is displayed at by element,
+    part is the part element belongs to. images shown without a size (e.g., vml) map to None and
+    are left alone
+    '''
+    for blip in element.iter(qn('a:blip')):
+        rId = blip.get(qn('r:embed'))
+        if rId is None or rId not in part.rels or part.rels[rId].is_external:
+            continue
+        img = part.rels[rId].target_part
+        drawing = next(blip.iterancestors(*_drawing_tags), None)
+        ext = drawing.find(qn('wp:extent')) if drawing is not None else None
+        if ext is None:
+            extents[img] = None
+            continue
+        size = (int(ext.get('cx')), int(ext.get('cy')))
+        if img not in extents:
+            extents[img] = size
+        elif extents[img] is not None:
+            extents[img] = (max(extents[img][0], size[0]), max(extents[img][1], size[1]))
+
+    for imagedata in element.iter(_vml_imagedata):
+        rId = imagedata.get(qn('r:id'))
+        if rId is not None and rId in part.rels and not part.rels[rId].is_external:
+            extents[part.rels[rId].target_part] = None
+    return extents
+
+def _is_photo(im):
+    if 'A' in im.getbands():
+        lo, hi = im.getchannel('A').getextrema()
+        if lo < 255:
+            return False
+    return im.getcolors(maxcolors=_photo_colors) is None
+
+def shrink_image(blob, size, quality):
+    '''
+    blob downscaled to fit size (width, height in pixels) and recompressed, png photos become jpeg
+    returns (blob, ext), or None if the image would not get any smaller
+    '''
+    with Image.open(io.BytesIO(blob)) as im:
+        fmt = im.format
+        if fmt not in ('PNG', 'JPEG', 'BMP', 'TIFF') or getattr(im, 'n_frames', 1) > 1:
+            return None
+        scale = min(size[0] / im.width, size[1] / im.height)
+        if fmt == 'JPEG' and scale >= 1:
+            # recompressing a jpeg at the same size only loses quality
+            return None
+
+        if im.mode in ('P', '1', 'LA', 'PA', 'I', 'I;16', 'F'):
+            im = im.convert('RGBA' if 'A' in im.mode or 'transparency' in im.info else 'RGB')
+        if scale < 1:
+            im = im.resize((max(1, round(im.width * scale)), max(1, round(im.height * scale))),
+                    Image.LANCZOS)
+
+        out = io.BytesIO()
+        if fmt == 'JPEG' or _is_photo(im):
+            ext = 'jpeg'
+            if im.mode not in ('RGB', 'L', 'CMYK'):
+                im = im.convert('RGB')
+            im.save(out, 'JPEG', quality=quality, optimize=True)
+        else:
+            ext = 'png'
+            im.save(out, 'PNG', optimize=True)
+
+    if out.tell() >= len(blob):
+        return None
+    return out.getvalue(), ext
+
+def _shrink_task(args):
+    return shrink_image(*args)
+
+def _cache_key(blob, size, quality):
+    return make_key('image', hashlib.sha256(blob).hexdigest(), '%dx%d' % size, str(quality),
+            PIL.__version__)
+
+def _cached(cache, key):
+    entry = cache.get(key) if cache is not None else None
+    if entry is None:
+        return False, None
+    if not entry:
+        # recorded as not worth shrinking
+        return True, None
+    ext, blob = entry.split(b'\n', 1)
+    return True, (blob, ext.decode())
+
+def _rename(part, ext, taken):
+    base = str(part.partname).rsplit('.', 1)[0]
+    name = f'{base}.{ext}'
+    n = 1
+    while name in taken:
+        name = f'{base}-{n}.{ext}'
+        n += 1
+    taken.discard(str(part.partname))
+    taken.add(name)
+    part.partname = PackURI(name)
+
+def optimize_images(doc, dpi, quality=85, jobs=1, cache=None, extents=None):
+    '''
+    downscale the images of doc to dpi at the largest size they are displayed at, and recompress
+    them. results are kept in cache (a FragmentCache) by image content, jobs is the number of
+    worker processes. extents has the sizes of images displayed by content no longer in doc
+    (see image_extents). returns (images replaced, bytes saved)
+    '''
+    if PIL is None:
+        log.warning('image_dpi needs Pillow (pip install Pillow), images are embedded as they are')
+        return 0, 0
+
+    extents = dict(extents or {})
+    package = doc.part.package
+    for part in package.iter_parts():
+        if hasattr(part, 'element') and len(part.rels):
+            image_extents(part.element, part, extents)
+
+    work = []
+    results = {}
+    for img, ext in extents.items():
+        if ext is None or img.content_type not in _formats.values():
+            continue
+        size = (math.ceil(ext[0] / Inches(1) * dpi), math.ceil(ext[1] / Inches(1) * dpi))
+        key = _cache_key(img.blob, size, quality)
+        hit, result = _cached(cache, key)
+        if hit:
+            results[img] = result
+        else:
+            work.append((img, size, key))
+
+    args = [(img.blob, size, quality) for img, size, _ in work]
+    if jobs is not None and jobs < 1:
+        jobs = os.cpu_count()
+    if jobs is not None and jobs > 1 and len(work) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            shrunk = list(pool.map(_shrink_task, args))
+    else:
+        shrunk = [_shrink_task(a) for a in args]
+
+    for (img, _, key), result in zip(work, shrunk):
+        results[img] = result
+        if cache is not None:
+            cache.put(key, b'' if result is None else result[1].encode() + b'\n' + result[0])
+
+    replaced = saved = 0
+    taken = {str(p.partname) for p in package.iter_parts()}
+    for img, result in results.items():
+        if result is None:
+            continue
+        blob, ext = result
+        saved += len(img.blob) - len(blob)
+        replaced += 1
+        img._blob = blob
+        if img.content_type != _formats[ext]:
+            img._content_type = _formats[ext]
+            _rename(img, ext, taken)
+    return replaced, saved
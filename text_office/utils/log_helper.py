@@ -24,6 +24,8 @@ log_handler = logging.StreamHandler(sys.stdout)
 log_handler.setLevel(logging.DEBUG)
 log_handler.setFormatter(log_formatter)
 
-log = logging.getLogger()
+# a logger of our own, the root logger (and the logging of other libraries) is left to the application
+log = logging.getLogger('text_office')
 log.setLevel(logging.DEBUG)
 log.addHandler(log_handler)
+log.propagate = False
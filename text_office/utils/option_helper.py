@@ -0,0 +1,129 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# docx_opts (-dxopt) compiled once into typed values
+
+from typing import NamedTuple, Optional, Union
+from docx.shared import Length
+
+from .errx_helper import InvalidAttr, InvalidValue
+from .parsers import parse_sizespec, parse_color, parse_table_align
+
+_true_values = ('1', 'yes', 'true')
+_false_values = ('0', 'no', 'false')
+
+def _parse_flag(v):
+    # stricter than parse_bool, anything else is an error rather than False
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, str) and v.casefold() in _true_values:
+        return True
+    if isinstance(v, str) and v.casefold() in _false_values:
+        return False
+    raise ValueError(v)
+
+def _parse_quality(v):
+    q = int(v)
+    if not 1 <= q <= 95:
+        raise ValueError(v)
+    return q
+
+def _parse_sizelist(v):
+    return [parse_sizespec(c.strip()) for c in v.split(',')]
+
+# default_figure_<key> and default_table_<key> options: (parser, description of valid values)
+# the parser only validates the value, format_figure and format_table are given the string
+_figure_opts = {
+        'width': (parse_sizespec, 'size spec (e.g., 3in)'),
+        'border_width': (parse_sizespec, 'size spec (e.g., 1pt)'),
+        'border_color': (parse_color, 'color name or hex'),
+        }
+
+_table_opts = {
+        'style': (str, 'table style name'),
+        'align': (parse_table_align, ('center', 'left', 'right')),
+        'autofit': (_parse_flag, _true_values + _false_values),
+        'column_widths': (_parse_sizelist, 'comma separated size specs'),
+        }
+
+# option: (parser, description of valid values)
+_scalar_opts = {
+        'error_on_blockcode': (_parse_flag, _true_values + _false_values),
+        'auto_left_indent': (parse_sizespec, 'size spec (e.g., 0.4in)'),
+        'prompt_updatefield': (_parse_flag, _true_values + _false_values),
+        'caption_prefix_heading': (int, 'heading level (int)'),
+        'precompute_fields': (_parse_flag, _true_values + _false_values),
+        'synthesize_styles': (int, 'minimum repeats (int), 0 disables'),
+        'image_dpi': (int, 'dots per inch (int), 0 disables'),
+        'image_quality': (_parse_quality, 'jpeg quality (1-95)'),
+        }
+
+def _valid_keys():
+    return list(_scalar_opts) + ['default_figure_' + k for k in _figure_opts] + \
+            ['default_table_' + k for k in _table_opts]
+
+class DocxOptions(NamedTuple):
+    '''
+    validated docx_opts, built with DocxOptions.compile()
+    immutable, hashable and picklable so it can key sessions and be sent to workers
+    '''
+    default_figure: tuple = () # (key, value) pairs for format_figure
+    default_table: tuple = () # (key, value) pairs for format_table
+    error_on_blockcode: bool = False
+    auto_left_indent: Optional[Union[Length, float]] = None
+    prompt_updatefield: bool = True
+    caption_prefix_heading: int = 0
+    precompute_fields: bool = False # caption numbers and toc entries are written out, see field_helper
+    synthesize_styles: int = 0 # formatting repeated this many times becomes a style
+    image_dpi: int = 0 # images are downscaled to this resolution at their displayed size
+    image_quality: int = 85
+
+    @classmethod
+    def compile(cls, docx_opts=None):
+        '''
+        compile a dict of option strings, raises InvalidAttr on unknown options
+        and InvalidValue on values that can't be parsed
+        '''
+        if isinstance(docx_opts, cls):
+            return docx_opts
+        if not docx_opts:
+            return cls()
+
+        fields = {}
+        figure = {}
+        table = {}
+        for k, v in docx_opts.items():
+            if k in _scalar_opts:
+                parser, valids = _scalar_opts[k]
+                fields[k] = _parse(k, v, parser, valids)
+            elif k.startswith('default_figure_') and k[15:] in _figure_opts:
+                _parse(k, v, *_figure_opts[k[15:]])
+                figure[k[15:]] = v
+            elif k.startswith('default_table_') and k[14:] in _table_opts:
+                _parse(k, v, *_table_opts[k[14:]])
+                table[k[14:]] = v
+            else:
+                raise InvalidAttr(k, _valid_keys())
+
+        return cls(default_figure=tuple(sorted(figure.items())),
+                default_table=tuple(sorted(table.items())), **fields)
+
+def _parse(k, v, parser, valids):
+    try:
+        return parser(v)
+    except Exception as e:
+        raise InvalidValue(k, v, valids)
@@ -17,6 +17,7 @@ Copyright (C) 2023 ToraNova
 
 import webcolors
 import re
+from functools import lru_cache
 from shlex import shlex
 from docx.shared import Pt, Inches, Cm, Mm, RGBColor, Length
 from docx.enum.section import WD_SECTION, WD_ORIENT
@@ -24,6 +25,7 @@ from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_TAB_ALIGNMENT
 from docx.enum.table import WD_TABLE_ALIGNMENT
 from .errx_helper import ensure_valid_value
 
+@lru_cache(maxsize=1024)
 def parse_color(color):
     if color is None:
         return None
@@ -47,6 +49,7 @@ def parse_color(color):
     raise ValueError(f'unable to parse color: {color}')
 
 
+@lru_cache(maxsize=1024)
 def parse_sizespec(sizespec):
     if sizespec is None:
         return None
@@ -24,7 +24,19 @@ _lib_ = _base_[:-_base_[::-1].find(os.path.sep)-1]
 prj_root_path = _lib_[:-_lib_[::-1].find(os.path.sep)]
 boiler_template_path = os.path.join(prj_root_path, 'boiler_templates')
 
-_mainmod_path_ = os.path.abspath(sys.modules['__main__'].__file__)
-_mainmod_base_, _mainmod_file_ = os.path.split(_mainmod_path_)
-_local_path_ = _mainmod_base_[:-_mainmod_base_[::-1].find(os.path.sep)-1]
-boiler_template_path_pip = os.path.join(_local_path_, 'boiler_templates')
+def _pip_template_path():
+    # boiler templates installed next to the main script, an interactive session or an embedding
+    # application has no main script and uses the project templates
+    main = getattr(sys.modules.get('__main__'), '__file__', None)
+    if main is None:
+        return boiler_template_path
+    _mainmod_base_, _mainmod_file_ = os.path.split(os.path.abspath(main))
+    _local_path_ = _mainmod_base_[:-_mainmod_base_[::-1].find(os.path.sep)-1]
+    return os.path.join(_local_path_, 'boiler_templates')
+
+def __getattr__(name):
+    # looked up on first use rather than at import (PEP 562)
+    if name == 'boiler_template_path_pip':
+        globals()[name] = _pip_template_path()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
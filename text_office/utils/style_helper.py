@@ -0,0 +1,164 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# character and paragraph styles synthesized from repeated direct formatting
+
+import hashlib
+from collections import Counter
+from copy import deepcopy
+
+from docx.enum.style import WD_STYLE_TYPE
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+
+def _tags(*names):
+    return frozenset(qn('w:' + n) for n in names)
+
+# run properties that can move into a character style
+# toggle properties (b, i, strike, ...) are left out, in a style they flip the inherited
+# value instead of setting it, so only direct formatting means the same thing everywhere
+_run_props = _tags('rFonts', 'color', 'spacing', 'w', 'kern', 'position', 'sz', 'szCs',
+        'highlight', 'u', 'shd', 'vertAlign', 'lang')
+
+# paragraph properties that can move into a paragraph style
+_para_props = _tags('keepNext', 'keepLines', 'pageBreakBefore', 'widowControl', 'pBdr', 'shd',
+        'tabs', 'spacing', 'ind', 'jc')
+
+# paragraphs in these styles are left alone, numbering restarts (docxcompose) and TOC fields
+# look at the paragraph's own style
+_keep_style_props = _tags('numPr', 'outlineLvl')
+
+def _canon(e):
+    # namespace-prefix independent form of an element, identical formatting gives identical keys
+    return (e.tag, tuple(sorted(e.attrib.items())), tuple(_canon(c) for c in e))
+
+class StyleSynthesizer:
+    '''
+    moves formatting combinations that repeat at least min_count times out of the runs and
+    paragraphs into character and paragraph styles of the document.
+    style ids are derived from the formatting itself, so documents composed together agree on
+    them and docxcompose keeps a single copy
+    '''
+    def __init__(self, docx, min_count=2):
+        self.styles = docx.styles.element
+        self.min_count = min_count
+        self.counts = Counter()
+        self.created = {} # key -> style id
+        self.keep_base = {} # paragraph style id -> True if its paragraphs are left alone
+        default = self.styles.default_for(WD_STYLE_TYPE.PARAGRAPH)
+        self.default_para = default.styleId if default is not None else None
+
+    def process(self, elements):
+        '''
+        count the formatting of the runs and paragraphs in elements, those whose formatting has
+        been seen min_count times so far (including in earlier calls) are given a style
+        '''
+        found = []
+        for e in elements:
+            for r in e.iter(qn('w:r')):
+                key = self._run_key(r)
+                if key is not None:
+                    found.append((r, key))
+            for p in e.iter(qn('w:p')):
+                key = self._para_key(p)
+                if key is not None:
+                    found.append((p, key))
+
+        self.counts.update(k for _, k in found)
+        for el, key in found:
+            if self.counts[key] >= self.min_count:
+                self._restyle(el, key)
+
+    def _run_key(self, r):
+        rPr = r.rPr
+        if rPr is None or rPr.rStyle is not None:
+            return None
+        props = tuple(_canon(c) for c in rPr if c.tag in _run_props)
+        if not props:
+            return None
+        return (WD_STYLE_TYPE.CHARACTER, None, props)
+
+    def _para_key(self, p):
+        pPr = p.pPr
+        if pPr is None or pPr.numPr is not None:
+            return None
+        base = pPr.style
+        if base is None and p.getparent().tag == qn('w:tc'):
+            # table styles only override the default paragraph style in Word
+            return None
+        if self._keep(base):
+            return None
+        props = tuple(_canon(c) for c in pPr if c.tag in _para_props)
+        if not props:
+            return None
+        return (WD_STYLE_TYPE.PARAGRAPH, base, props)
+
+    def _keep(self, style_id):
+        if style_id is None:
+            return False
+        if style_id not in self.keep_base:
+            keep = False
+            seen = set()
+            style = self.styles.get_by_id(style_id)
+            while style is not None and style.styleId not in seen:
+                seen.add(style.styleId)
+                if style.pPr is not None and any(c.tag in _keep_style_props for c in style.pPr):
+                    keep = True
+                    break
+                style = self.styles.get_by_id(style.basedOn_val) if style.basedOn_val else None
+            self.keep_base[style_id] = keep
+        return self.keep_base[style_id]
+
+    def _restyle(self, el, key):
+        style_id = self.created.get(key)
+        if style_id is None:
+            style_id = self.created[key] = self._add_style(el, key)
+
+        if key[0] == WD_STYLE_TYPE.CHARACTER:
+            props = el.rPr
+            props.style = style_id
+            tags = _run_props
+        else:
+            props = el.pPr
+            props.style = style_id
+            tags = _para_props
+        for c in [c for c in props if c.tag in tags]:
+            props.remove(c)
+
+    def _add_style(self, el, key):
+        stype, base, _ = key
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:10]
+        if stype == WD_STYLE_TYPE.CHARACTER:
+            kind, props, tags = 'Char', el.rPr, _run_props
+        else:
+            kind, props, tags = 'Para', el.pPr, _para_props
+            base = base or self.default_para
+        name = 'Text Office %s %s' % (kind, digest)
+        style_id = name.replace(' ', '')
+        if self.styles.get_by_id(style_id) is not None:
+            return style_id
+
+        style = self.styles.add_style_of_type(name, stype, False)
+        style.styleId = style_id
+        if base is not None:
+            style.basedOn_val = base
+        target = OxmlElement('w:rPr' if stype == WD_STYLE_TYPE.CHARACTER else 'w:pPr')
+        for c in props:
+            if c.tag in tags:
+                target.append(deepcopy(c))
+        style.append(target)
+        return style_id
@@ -0,0 +1,97 @@
+'''
+Copyright (C) 2023 ToraNova
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published
+    by the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# build timeline in the chrome trace event format (open with ui.perfetto.dev or chrome://tracing)
+# spans are only recorded between start() and stop(), otherwise span() does nothing
+#
+#   with trace.span('render', path=md) as args:
+#       doc = ...
+#       args['paragraphs'] = len(doc.paragraphs)
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# events recorded in this process, None when not tracing
+_events = None
+
+def start():
+    global _events
+    _events = []
+
+def stop():
+    '''
+    stop tracing, returns the events recorded in this process
+    '''
+    global _events
+    events = _events or []
+    _events = None
+    return events
+
+def enabled():
+    return _events is not None
+
+def add_events(events):
+    '''
+    merge events recorded elsewhere (e.g., by a worker process)
+    '''
+    if _events is not None:
+        _events.extend(events)
+
+@contextmanager
+def span(name, cat='build', **args):
+    '''
+    records a complete event around the block, the args dict is yielded so the block can
+    add to it (e.g., counts only known at the end)
+    '''
+    if _events is None:
+        yield args
+        return
+
+    # perf_counter uses a system wide monotonic clock, times from worker processes line up
+    begin = time.perf_counter_ns()
+    try:
+        yield args
+    finally:
+        end = time.perf_counter_ns()
+        _events.append({
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': begin / 1000,
+            'dur': (end - begin) / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'args': args,
+            })
+
+def save(path, events=None):
+    '''
+    write events (default: those recorded so far) to path as a trace event json file,
+    each process gets a name, the one that writes the file is the main process
+    '''
+    if events is None:
+        events = _events or []
+    main = os.getpid()
+    names = []
+    for pid in sorted({e['pid'] for e in events} | {main}):
+        names.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+            'args': {'name': 'text-office' if pid == main else f'worker {pid}'}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': names + events, 'displayTimeUnit': 'ms'}, f)